@@ -1,17 +1,52 @@
+import collections
 import datetime
+import hashlib
+import json
 import os
+import queue
 import shutil
 import subprocess
 import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from tqdm import tqdm
 from enum import Enum
 import humanize
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+from .compression import (
+    COMPRESSION,
+    READ_SIZE,
+    compressed_reader,
+    compression_suffix,
+    decompressed_reader,
+    split_compression_suffix,
+)
+from .catalog import (
+    USE_CATALOG,
+    add_to_catalog,
+    get_catalog_backups,
+    remove_from_catalog,
+    replace_catalog,
+)
+from .transfer import (
+    DOWNLOAD_N_WORKERS,
+    MAX_CONCURRENCY,
+    TRANSFER_ERRORS,
+    download_file,
+    object_info,
+    upload_file,
+    upload_fileobj,
+)
+
 
 IS_POSTGRES = any(
     db_type in settings.DATABASES["default"]["ENGINE"]
@@ -27,20 +62,52 @@ if IS_POSTGRES:
         DATABASE_BACKUP_FILE = os.path.join(settings.BASE_DIR, "compress.dump")
         FILE_FORMAT = f"{DATE_FORMAT}_postgres_backup.dump"
         BACKUP_RECOVER_N_WORKERS = getattr(settings, "BACKUP_RECOVER_N_WORKERS", 1)
+        DUMP_N_WORKERS = getattr(settings, "BACKUP_DUMP_N_WORKERS", 1)
     else:
         DATABASE_BACKUP_FILE = os.path.join(settings.BASE_DIR, "dump.sql")
         FILE_FORMAT = f"{DATE_FORMAT}_postgres_dump.sql"
+        # "inserts" for one INSERT by row, "copy" for COPY blocks, or "rows"
+        # for INSERTs of BACKUP_ROWS_PER_INSERT rows
+        PLAIN_FORMAT = getattr(settings, "BACKUP_PLAIN_FORMAT", "inserts")
+        ROWS_PER_INSERT = getattr(settings, "BACKUP_ROWS_PER_INSERT", 1000)
+    DATABASE_BACKUP_DIR = os.path.join(settings.BASE_DIR, "dump_directory")
+    # seconds between two checks of the files written by a parallel pg_dump
+    DUMP_POLL_INTERVAL = 1
     SELECT_ALL_PUBLIC_TABLES_QUERY = """select 'drop table if exists "' || tablename || '" cascade;' from pg_tables where schemaname = 'public';"""
 else:
     db_file_path = settings.DATABASES["default"]["NAME"]
     DATABASE_BACKUP_FILE = os.path.join(os.path.dirname(db_file_path), "backup.sqlite")
-    SQLITE_DUMP_COMMAND = (
-        """sqlite3 '{source_file}' ".backup '{backup_file}'" """.format(
-            source_file=db_file_path, backup_file=DATABASE_BACKUP_FILE
-        )
-    )
     FILE_FORMAT = f"{DATE_FORMAT}_db.sqlite"
+    SQLITE_PAGES_PER_STEP = getattr(settings, "BACKUP_SQLITE_PAGES_PER_STEP", 1024)
+    SQLITE_STEP_SLEEP = getattr(settings, "BACKUP_SQLITE_STEP_SLEEP", 0)
+    SQLITE_MAX_RESTARTS = getattr(settings, "BACKUP_SQLITE_MAX_RESTARTS", 3)
+    SQLITE_CHUNK_SIZE = getattr(settings, "BACKUP_SQLITE_CHUNK_SIZE", 4 * 1024**2)
+INCREMENTAL_DATABASE_BACKUP = not IS_POSTGRES and getattr(
+    settings, "BACKUP_SQLITE_INCREMENTAL", False
+)
+# dump with pg_dump --jobs in directory format, uploaded file by file
+DIRECTORY_DATABASE_BACKUP = (
+    IS_POSTGRES and COMPRESS_DATABASE_BACKUP and DUMP_N_WORKERS > 1
+)
+# postgres custom format dumps are already compressed by pg_dump
+if IS_POSTGRES and COMPRESS_DATABASE_BACKUP:
+    DATABASE_COMPRESSION = None
+else:
+    DATABASE_COMPRESSION = COMPRESSION
 KEEP_N_DAYS = getattr(settings, "BACKUP_KEEP_N_DAYS", 31)
+DB_BACKUP_PREFIX = getattr(settings, "BACKUP_DB_PREFIX", "db")
+STREAM_BACKUP = getattr(settings, "BACKUP_STREAM", False)
+STREAM_RECOVER = getattr(settings, "BACKUP_STREAM_RECOVER", False)
+UPLOAD_N_WORKERS = getattr(settings, "BACKUP_UPLOAD_N_WORKERS", 1)
+UPLOAD_RETRIES = getattr(settings, "BACKUP_UPLOAD_RETRIES", 3)
+DELETE_N_WORKERS = getattr(settings, "BACKUP_DELETE_N_WORKERS", 4)
+# maximum number of keys accepted by a DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+# listed objects buffered ahead of their consumer, about 10 pages
+PREFETCH_SIZE = 10000
+LIST_N_WORKERS = getattr(settings, "BACKUP_LIST_N_WORKERS", 4)
+# levels of "/" delimited sub-prefixes explored to find shards to list concurrently
+SHARD_DISCOVERY_DEPTH = 3
 region = getattr(settings, "BACKUP_REGION", None)
 if getattr(settings, "BACKUP_USE_AWS", None) and region:
     host = f"s3.{region}.amazonaws.com"
@@ -48,6 +115,10 @@ else:
     region = region or "fr-par"
     host = getattr(settings, "BACKUP_HOST", "s3.fr-par.scw.cloud")
 LAST_BACKUP_FILE = os.path.join(settings.BASE_DIR, ".telescoop_backup_last_backup")
+DATABASE_BACKUP_TYPE = "database"
+DATABASE_CHUNK_STORE = "db"
+# suffix of the keys of backups stored as a manifest of chunks or files
+MANIFEST_SUFFIX = ".manifest"
 BUCKET = settings.BACKUP_BUCKET
 
 # Security backup settings
@@ -55,6 +126,13 @@ SECURITY_BACKUP_HOST = getattr(settings, "SECURITY_BACKUP_HOST", host)
 SECURITY_BACKUP_REGION = getattr(settings, "SECURITY_BACKUP_REGION", region)
 MAX_PAGINATION_ITERATIONS = getattr(settings, "BACKUP_MAX_PAGINATION_ITERATIONS", 10000)
 
+# S3 client settings
+MAX_POOL_CONNECTIONS = getattr(settings, "BACKUP_MAX_POOL_CONNECTIONS", 50)
+RETRY_MODE = getattr(settings, "BACKUP_RETRY_MODE", "standard")
+MAX_ATTEMPTS = getattr(settings, "BACKUP_MAX_ATTEMPTS", 5)
+CONNECT_TIMEOUT = getattr(settings, "BACKUP_CONNECT_TIMEOUT", 60)
+READ_TIMEOUT = getattr(settings, "BACKUP_READ_TIMEOUT", 60)
+
 
 class BackupType(Enum):
     MAIN = "main"
@@ -73,32 +151,64 @@ CLIENT_PARAMS_BY_BACKUP = {
 }
 
 
-def boto_client(backup_type=BackupType.MAIN):
-    """Connect to AWS S3."""
+_clients = {}
+_clients_lock = threading.Lock()
 
-    return boto3.client(
-        "s3",
-        aws_access_key_id=settings.BACKUP_ACCESS,
-        aws_secret_access_key=settings.BACKUP_SECRET,
-        **CLIENT_PARAMS_BY_BACKUP[backup_type],
-    )
 
+def boto_client(backup_type=BackupType.MAIN, max_pool_connections=None):
+    """
+    Connect to AWS S3, with a client shared by the whole process.
 
-def _list_objects_paginated(connexion, bucket, prefix=""):
-    """List all objects in a bucket with pagination support."""
-    all_objects = []
+    Clients are thread-safe and cached by backup type, so that connections
+    are reused. A client is only created again if max_pool_connections is
+    larger than the pool of the cached one.
+    """
+    pool_size = max(max_pool_connections or 0, MAX_POOL_CONNECTIONS)
+    with _clients_lock:
+        cached = _clients.get(backup_type)
+        if cached and cached[0] >= pool_size:
+            return cached[1]
+
+        config = Config(
+            max_pool_connections=pool_size,
+            retries={"mode": RETRY_MODE, "total_max_attempts": MAX_ATTEMPTS},
+            connect_timeout=CONNECT_TIMEOUT,
+            read_timeout=READ_TIMEOUT,
+        )
+        # the default session is not thread-safe
+        client = boto3.session.Session().client(
+            "s3",
+            aws_access_key_id=settings.BACKUP_ACCESS,
+            aws_secret_access_key=settings.BACKUP_SECRET,
+            config=config,
+            **CLIENT_PARAMS_BY_BACKUP[backup_type],
+        )
+        _clients[backup_type] = (pool_size, client)
+        return client
+
+
+# compact record of a listed object, for listings of millions of objects
+ListedObject = collections.namedtuple(
+    "ListedObject", ["key", "size", "etag", "last_modified"]
+)
+
+
+def _list_pages(connexion, bucket, prefix="", delimiter=None, start_after=None):
+    """Yield the pages of a listing, at most MAX_PAGINATION_ITERATIONS of them."""
     continuation_token = None
     iteration_count = 0
 
     while iteration_count < MAX_PAGINATION_ITERATIONS:
         list_kwargs = {"Bucket": bucket, "Prefix": prefix}
+        if delimiter:
+            list_kwargs["Delimiter"] = delimiter
+        if start_after:
+            list_kwargs["StartAfter"] = start_after
         if continuation_token:
             list_kwargs["ContinuationToken"] = continuation_token
 
         objects = connexion.list_objects_v2(**list_kwargs)
-
-        if "Contents" in objects:
-            all_objects.extend(objects["Contents"])
+        yield objects
 
         has_more_objects = objects.get("IsTruncated", False)
         continuation_token = objects.get("NextContinuationToken")
@@ -114,77 +224,744 @@ def _list_objects_paginated(connexion, bucket, prefix=""):
             f"Warning: Reached maximum iteration limit ({MAX_PAGINATION_ITERATIONS}) in _list_objects_paginated"
         )
 
+
+def _list_objects_paginated(connexion, bucket, prefix="", delimiter=None):
+    """
+    List all objects in a bucket with pagination support.
+
+    With a delimiter, only objects directly under prefix are listed.
+    """
+    all_objects = []
+    for page in _list_pages(connexion, bucket, prefix, delimiter):
+        all_objects.extend(page.get("Contents", []))
     return all_objects
 
 
+def iter_objects(connexion, bucket, prefix="", start_after=None):
+    """
+    Yield a ListedObject for each object under prefix, in key order, page by page.
+
+    With start_after, only keys after it are listed.
+    """
+    for page in _list_pages(connexion, bucket, prefix, start_after=start_after):
+        for obj in page.get("Contents", []):
+            yield ListedObject(
+                obj["Key"], obj["Size"], obj["ETag"], obj["LastModified"]
+            )
+
+
+def _shard_entries(connexion, bucket, prefix, n_shards, start_after=None):
+    """
+    Split the listing of prefix into direct objects and sub-prefixes, in key order.
+
+    Entries are (key, ListedObject) for objects and (prefix, None) for
+    shards. Sub-prefixes are found with the "/" delimiter, a few levels
+    deep until there are n_shards of them. A prefix with more than one page
+    of direct entries is kept as a single shard, so that discovery never
+    walks a large flat listing. With start_after, entries before it are
+    dropped.
+    """
+    entries = [(prefix, None)]
+    for _ in range(SHARD_DISCOVERY_DEPTH):
+        if len([obj for key, obj in entries if obj is None]) >= n_shards:
+            break
+        expanded = []
+        for key, obj in entries:
+            if obj is not None:
+                expanded.append((key, obj))
+                continue
+            page = connexion.list_objects_v2(Bucket=bucket, Prefix=key, Delimiter="/")
+            if page.get("IsTruncated"):
+                expanded.append((key, None))
+                continue
+            expanded += [
+                (
+                    obj["Key"],
+                    ListedObject(
+                        obj["Key"], obj["Size"], obj["ETag"], obj["LastModified"]
+                    ),
+                )
+                for obj in page.get("Contents", [])
+            ]
+            expanded += [
+                (common_prefix["Prefix"], None)
+                for common_prefix in page.get("CommonPrefixes", [])
+            ]
+        expanded.sort(key=lambda entry: entry[0])
+        if expanded == entries:
+            break
+        entries = expanded
+
+    if start_after:
+        # drop the objects and shards whose keys are all before start_after
+        entries = [
+            (key, obj)
+            for key, obj in entries
+            if key > start_after or (obj is None and start_after.startswith(key))
+        ]
+    return entries
+
+
+def iter_objects_sharded(
+    connexion, bucket, prefix="", n_workers=None, start_after=None
+):
+    """
+    Yield a ListedObject for each object under prefix, in key order.
+
+    The prefix is split into shards by _shard_entries, and n_workers shards
+    are listed at the same time, each in its own thread, while they are
+    yielded in order. A direct object sorts either before or after all
+    the keys of a shard, so the merged stream stays sorted.
+    """
+    if n_workers is None:
+        n_workers = LIST_N_WORKERS
+    if n_workers <= 1:
+        yield from iter_objects(connexion, bucket, prefix, start_after)
+        return
+
+    entries = collections.deque(
+        _shard_entries(connexion, bucket, prefix, n_workers, start_after)
+    )
+    window = collections.deque()
+    n_listing = 0
+    try:
+        while window or entries:
+            # start listing the next shards while the first one is consumed
+            while entries and n_listing < n_workers:
+                key, obj = entries.popleft()
+                if obj is None:
+                    window.append(
+                        _prefetch(iter_objects(connexion, bucket, key, start_after))
+                    )
+                    n_listing += 1
+                else:
+                    window.append(obj)
+            source = window.popleft()
+            if isinstance(source, ListedObject):
+                yield source
+            else:
+                yield from source
+                n_listing -= 1
+    finally:
+        for source in window:
+            if not isinstance(source, ListedObject):
+                source.close()
+
+
+def iter_prefixes(connexion, bucket, prefixes, start_after=None):
+    """
+    Yield a ListedObject for each object under any of the prefixes, in key order.
+
+    Prefixes inside another one are skipped, so that no object is listed twice.
+    With start_after, only keys after it are listed.
+    """
+    previous = None
+    for prefix in sorted(prefixes):
+        if previous is not None and prefix.startswith(previous):
+            continue
+        previous = prefix
+        yield from iter_objects_sharded(
+            connexion, bucket, prefix, start_after=start_after
+        )
+
+
+def _put(items, stop, entry):
+    """Put entry in items, giving up when stop is set instead of blocking forever."""
+    while not stop.is_set():
+        try:
+            items.put(entry, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _produce(iterable, items, stop):
+    """Thread target of _Prefetcher, it holds no reference to the prefetcher."""
+    try:
+        for item in iterable:
+            if not _put(items, stop, ("item", item)):
+                break
+        else:
+            _put(items, stop, ("done", None))
+    except Exception as e:
+        _put(items, stop, ("error", e))
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+
+
+class _Prefetcher:
+    """
+    Iterate over iterable in a background thread, up to max_size items ahead.
+
+    Listing pages are then fetched while the previous ones are processed.
+    Errors of the iteration are raised to the consumer. The thread runs
+    until the iterable is exhausted or the prefetcher is closed, so a
+    prefetcher that is not read to the end must be closed.
+    """
+
+    def __init__(self, iterable, max_size=PREFETCH_SIZE):
+        self._items = queue.Queue(maxsize=max_size)
+        self._stop = threading.Event()
+        self._done = False
+        threading.Thread(
+            target=_produce, args=(iterable, self._items, self._stop), daemon=True
+        ).start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        kind, value = self._items.get()
+        if kind == "item":
+            return value
+        self.close()
+        if kind == "error":
+            raise value
+        raise StopIteration
+
+    def close(self):
+        self._done = True
+        self._stop.set()
+
+
+def _prefetch(iterable, max_size=PREFETCH_SIZE):
+    """Start iterating over iterable in a background thread, see _Prefetcher."""
+    return _Prefetcher(iterable, max_size)
+
+
 def _file_exists_in_bucket(connexion, bucket, key):
     """Check if a file exists in the bucket."""
+    return _object_etag(connexion, bucket, key) is not None
+
+
+def _object_etag(connexion, bucket, key):
+    """ETag of an object without quotes, None if it does not exist."""
     try:
-        connexion.head_object(Bucket=bucket, Key=key)
-        return True
+        return connexion.head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
     except ClientError as e:
         if e.response["Error"]["Code"] == "404":
-            return False
+            return None
         raise
 
 
-def _copy_objects_with_progress(objects, copy_func, progress_desc):
-    """Copy objects with progress bar and error handling."""
-    with tqdm(objects, desc=progress_desc) as pbar:
-        for obj in pbar:
-            success = copy_func(obj, pbar)
-            if success:
-                pbar.write(f"Successfully processed {obj.get('Key', 'object')}")
+def _copy_objects_with_progress(objects, copy_func, progress_desc, n_workers=1):
+    """
+    Copy objects with progress bar and error handling, using n_workers threads.
 
+    Return the number of objects processed and of successful copies.
+    """
+    total = len(objects) if hasattr(objects, "__len__") else None
+    n_processed = n_succeeded = 0
+    with tqdm(total=total, desc=progress_desc) as pbar:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            in_flight = {}
+
+            def collect(futures):
+                nonlocal n_processed, n_succeeded
+                for future in futures:
+                    obj = in_flight.pop(future)
+                    n_processed += 1
+                    if future.result():
+                        n_succeeded += 1
+                        pbar.write(f"Successfully processed {obj.key}")
+                    pbar.update(1)
+
+            try:
+                for obj in objects:
+                    # bound the number of pending copies for very large listings
+                    if len(in_flight) >= 2 * n_workers:
+                        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    in_flight[executor.submit(copy_func, obj, pbar)] = obj
+
+                collect(list(in_flight))
+            finally:
+                # stop listing in the background if the copies failed
+                if hasattr(objects, "close"):
+                    objects.close()
+    return n_processed, n_succeeded
+
+
+def backup_file(
+    file_path: str,
+    remote_key: str,
+    connexion=None,
+    skip_if_exists=False,
+    progress=True,
+    md5=None,
+):
+    """
+    Backup backup_file on third-party server.
 
-def backup_file(file_path: str, remote_key: str, connexion=None, skip_if_exists=False):
-    """Backup backup_file on third-party server."""
+    Return whether it was uploaded, it is not with skip_if_exists when
+    remote_key already exists, and has the ETag md5 if given.
+    """
     if connexion is None:
         connexion = boto_client()
 
-    if skip_if_exists and _file_exists_in_bucket(connexion, BUCKET, remote_key):
-        return
-    connexion.upload_file(file_path, BUCKET, remote_key)
+    if skip_if_exists:
+        etag = _object_etag(connexion, BUCKET, remote_key)
+        if etag is not None and (md5 is None or etag == md5):
+            return False
+    upload_file(connexion, file_path, BUCKET, remote_key, progress=progress)
+    return True
 
 
-def backup_folder(path: str, remote_path: str, connexion=None):
-    """Recursively backup entire folder. Ignores paths that were already backup up."""
+def _load_manifest(manifest_file):
+    """Load a local backup manifest, empty if it does not exist yet."""
+    if not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file, "r") as fh:
+        return json.load(fh)
+
+
+def _save_manifest(manifest_file, manifest):
+    """Atomically write a local backup manifest."""
+    tmp_file = f"{manifest_file}.tmp"
+    with open(tmp_file, "w") as fh:
+        json.dump(manifest, fh)
+    os.replace(tmp_file, manifest_file)
+
+
+def _file_md5(file_path):
+    """Compute the md5 hex digest of a file."""
+    file_hash = hashlib.md5()
+    with open(file_path, "rb") as fh:
+        for block in iter(lambda: fh.read(1024**2), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def _backup_file_with_retries(file_path, remote_key, connexion, skip_if_exists, md5):
+    """Backup a file like backup_file, retrying up to UPLOAD_RETRIES times on failure."""
+    for attempt in range(1, UPLOAD_RETRIES + 1):
+        try:
+            return backup_file(
+                file_path,
+                remote_key,
+                connexion=connexion,
+                skip_if_exists=skip_if_exists,
+                progress=False,
+                md5=md5,
+            )
+        except TRANSFER_ERRORS:
+            if attempt >= UPLOAD_RETRIES:
+                raise
+            time.sleep(2**attempt)
+
+
+def _backup_files(uploads, connexion):
+    """
+    Upload (file_path, remote_key, skip_if_exists, md5) tuples with UPLOAD_N_WORKERS threads.
+
+    Return the remote keys that were backed up, uploaded or already in the
+    bucket, and those that failed.
+    """
+    backed_up, failed = [], []
+    n_skipped = total_size = 0
+    start = time.monotonic()
+
+    with tqdm(total=len(uploads), desc="Uploading files", unit="file") as pbar:
+        with ThreadPoolExecutor(max_workers=UPLOAD_N_WORKERS) as executor:
+            futures = {
+                executor.submit(
+                    _backup_file_with_retries,
+                    file_path,
+                    remote_key,
+                    connexion,
+                    skip_if_exists,
+                    md5,
+                ): (file_path, remote_key)
+                for file_path, remote_key, skip_if_exists, md5 in uploads
+            }
+            for future in as_completed(futures):
+                file_path, remote_key = futures[future]
+                try:
+                    uploaded = future.result()
+                except TRANSFER_ERRORS as e:
+                    pbar.write(f"Error uploading {file_path}: {e}")
+                    failed.append(remote_key)
+                else:
+                    backed_up.append(remote_key)
+                    if uploaded:
+                        total_size += os.path.getsize(file_path)
+                    else:
+                        n_skipped += 1
+                pbar.update(1)
+
+    elapsed = max(time.monotonic() - start, 1e-6)
+    size_human = humanize.naturalsize(total_size, binary=True)
+    rate_human = humanize.naturalsize(total_size / elapsed, binary=True)
+    print(
+        f"Uploaded {len(backed_up) - n_skipped} files ({size_human}) in {elapsed:.1f}s ({rate_human}/s), "
+        f"skipped {n_skipped} files already in the bucket"
+    )
+    return backed_up, failed
+
+
+def backup_folder(path: str, remote_path: str, connexion=None, manifest_file=None):
+    """
+    Recursively backup entire folder. Ignores paths that were already backup up.
+
+    Without manifest_file, every file is checked on the bucket with a HEAD
+    request. With manifest_file, a local manifest of (size, mtime, md5) per
+    remote key is diffed against the folder, and only new or changed files
+    are uploaded. Files are uploaded by UPLOAD_N_WORKERS threads.
+    """
     if connexion is None:
-        connexion = boto_client()
-    number_of_files = sum([len(files) for root, dirs, files in os.walk(path)])
-    if number_of_files > 100:
-        print(
-            "Warning: you are about to backup a large number of files. You may want to use --zipped option."
+        connexion = boto_client(
+            max_pool_connections=max(UPLOAD_N_WORKERS, MAX_CONCURRENCY)
         )
-    for root, dirs, files in os.walk(path):
-        for file in files:
+
+    files = []
+    for root, dirs, file_names in os.walk(path):
+        for file in file_names:
             path_no_base = os.path.join(root, file)
             dest = os.path.join(remote_path, os.path.relpath(path_no_base, start=path))
-            backup_file(path_no_base, dest, connexion=connexion, skip_if_exists=True)
+            files.append((path_no_base, dest))
+
+    if manifest_file is None:
+        if len(files) > 100:
+            print(
+                "Warning: you are about to backup a large number of files. You may want to use --zipped option."
+            )
+        uploads = [(path_no_base, dest, True, None) for path_no_base, dest in files]
+        backed_up, failed = _backup_files(uploads, connexion)
+    else:
+        previous_manifest = _load_manifest(manifest_file)
+        manifest = {}
+        pending_entries = {}
+        uploads = []
+        for path_no_base, dest in files:
+            stat = os.stat(path_no_base)
+            entry = previous_manifest.get(dest)
+            if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+                manifest[dest] = entry
+                continue
+
+            md5 = _file_md5(path_no_base)
+            new_entry = [stat.st_size, stat.st_mtime_ns, md5]
+            if entry and entry[2] == md5:
+                manifest[dest] = new_entry
+                continue
+            if entry:
+                # kept until the upload succeeds, so that a failed one is retried
+                manifest[dest] = entry
+            # files missing from the manifest may have been uploaded before it
+            # existed, they are skipped if the object has the same md5 ETag,
+            # which multipart uploads do not have
+            uploads.append((path_no_base, dest, entry is None, md5))
+            pending_entries[dest] = new_entry
+
+        print(f"{len(uploads)} new or changed files out of {len(files)} in {path}")
+        try:
+            backed_up, failed = _backup_files(uploads, connexion)
+            for dest in backed_up:
+                manifest[dest] = pending_entries[dest]
+        finally:
+            _save_manifest(manifest_file, manifest)
+
+    if failed:
+        raise RuntimeError(f"Could not backup {len(failed)} files of {path}")
+
+
+def _postgres_env():
+    """Environment for postgres commands, with the password if one is set."""
+    db_password = settings.DATABASES["default"].get("PASSWORD")
+    if not db_password:
+        return None
+    env = os.environ.copy()
+    env["PGPASSWORD"] = db_password
+    return env
+
+
+def postgres_dump_command(output_file=None):
+    """Build the pg_dump command, writing to stdout if output_file is None."""
+    db_name = settings.DATABASES["default"]["NAME"]
+    db_user = settings.DATABASES["default"]["USER"]
+    if DIRECTORY_DATABASE_BACKUP:
+        shell_cmd = f"pg_dump -U {db_user} -d {db_name} -F d --jobs {DUMP_N_WORKERS} --no-acl -f {output_file}"
+    elif COMPRESS_DATABASE_BACKUP:
+        shell_cmd = f"pg_dump -U {db_user} -d {db_name} -F c --no-acl"
+        if output_file:
+            shell_cmd += f" -f {output_file}"
+    else:
+        shell_cmd = f"pg_dump -d {db_name} -U {db_user}"
+        if PLAIN_FORMAT == "inserts":
+            shell_cmd += " --inserts"
+        elif PLAIN_FORMAT == "rows":
+            shell_cmd += f" --rows-per-insert {ROWS_PER_INSERT}"
+        elif PLAIN_FORMAT != "copy":
+            raise ImproperlyConfigured(f"Unknown BACKUP_PLAIN_FORMAT {PLAIN_FORMAT}")
+        if output_file:
+            shell_cmd += f" > {output_file}"
+    return shell_cmd
 
 
 def dump_database():
     """Dump the database to a file."""
     if IS_POSTGRES:
+        shell_cmd = postgres_dump_command(DATABASE_BACKUP_FILE)
+        subprocess.check_output(shell_cmd, shell=True, env=_postgres_env())
+    else:
+        dump_sqlite_database()
 
-        db_name = settings.DATABASES["default"]["NAME"]
-        db_user = settings.DATABASES["default"]["USER"]
-        db_password = settings.DATABASES["default"].get("PASSWORD")
-        if COMPRESS_DATABASE_BACKUP:
-            shell_cmd = f"pg_dump -U {db_user} -d {db_name} -F c --no-acl -f {DATABASE_BACKUP_FILE}"
-        else:
-            shell_cmd = (
-                f"pg_dump -d {db_name} -U {db_user} --inserts > {DATABASE_BACKUP_FILE}"
+
+class _SQLiteBackupRestarted(Exception):
+    """The SQLite backup restarted more than SQLITE_MAX_RESTARTS times."""
+
+
+def dump_sqlite_database():
+    """
+    Copy the SQLite database with the online backup API.
+
+    Pages are copied SQLITE_PAGES_PER_STEP at a time, and the database is
+    unlocked between steps so that writers are not stalled by the backup.
+    A write from another connection restarts the backup from the first
+    page, so after SQLITE_MAX_RESTARTS restarts the database is copied in
+    a single step instead, locking out writers until it is done.
+    """
+    if os.path.exists(DATABASE_BACKUP_FILE):
+        os.remove(DATABASE_BACKUP_FILE)
+    source = sqlite3.connect(db_file_path)
+    destination = sqlite3.connect(DATABASE_BACKUP_FILE)
+    try:
+        with tqdm(desc="Backing up SQLite database", unit="page") as pbar:
+            n_restarts = 0
+
+            def progress(status, remaining, total):
+                nonlocal n_restarts
+                if total - remaining < pbar.n:
+                    n_restarts += 1
+                    if n_restarts > SQLITE_MAX_RESTARTS:
+                        raise _SQLiteBackupRestarted
+                    pbar.reset()
+                pbar.total = total
+                pbar.update(total - remaining - pbar.n)
+                if SQLITE_STEP_SLEEP:
+                    time.sleep(SQLITE_STEP_SLEEP)
+
+            try:
+                source.backup(
+                    destination, pages=SQLITE_PAGES_PER_STEP, progress=progress
+                )
+            except _SQLiteBackupRestarted:
+                pbar.write(
+                    f"SQLite backup restarted {n_restarts} times by concurrent writes, "
+                    "copying the database in a single step"
+                )
+                pbar.reset()
+                source.backup(destination)
+                pbar.update(pbar.total)
+    finally:
+        destination.close()
+        source.close()
+
+
+def stream_database_to_online_backup(date=None):
+    """
+    Pipe pg_dump output straight into a multipart upload.
+
+    The dump is never written to disk, and the upload starts as soon as
+    pg_dump produces its first bytes.
+    """
+    connexion = boto_client(BackupType.MAIN)
+    remote_key = db_name(date)
+    shell_cmd = postgres_dump_command()
+    process = subprocess.Popen(
+        shell_cmd, shell=True, stdout=subprocess.PIPE, env=_postgres_env()
+    )
+    try:
+        dump_stream = process.stdout
+        if DATABASE_COMPRESSION:
+            dump_stream = compressed_reader(dump_stream, DATABASE_COMPRESSION)
+        upload_fileobj(
+            connexion, dump_stream, BUCKET, remote_key, size=_postgres_database_size()
+        )
+    finally:
+        process.stdout.close()
+        return_code = process.wait()
+
+    if return_code:
+        # the uploaded object is a truncated dump, do not keep it
+        connexion.delete_object(Bucket=BUCKET, Key=remote_key)
+        raise subprocess.CalledProcessError(return_code, shell_cmd)
+
+    record_backup(connexion, remote_key, FILE_FORMAT, DATABASE_BACKUP_TYPE)
+
+
+def _directory_prefix(manifest_key):
+    """Prefix of the files of a directory format dump."""
+    return f"{manifest_key[: -len(MANIFEST_SUFFIX)]}.d/"
+
+
+def _directory_stats(path):
+    """Size and modification time by file name of the files in a directory."""
+    if not os.path.isdir(path):
+        return {}
+    return {
+        entry.name: (entry.stat().st_size, entry.stat().st_mtime_ns)
+        for entry in os.scandir(path)
+        if entry.is_file()
+    }
+
+
+def _upload_dump_directory(process, connexion, remote_prefix):
+    """
+    Upload the files of a running directory format dump as they are written.
+
+    Return the stats of the uploaded files by name and the return code of
+    pg_dump, which is killed if the uploads fail.
+    """
+    uploaded = {}
+    in_flight = {}
+    previous = {}
+    try:
+        with ThreadPoolExecutor(max_workers=DUMP_N_WORKERS) as executor:
+            while True:
+                finished = process.poll() is not None
+                current = _directory_stats(DATABASE_BACKUP_DIR)
+                uploading = {file_name for file_name, stat in in_flight.values()}
+                for file_name, stat in current.items():
+                    if uploaded.get(file_name) == stat or file_name in uploading:
+                        continue
+                    if finished or previous.get(file_name) == stat:
+                        future = executor.submit(
+                            backup_file,
+                            os.path.join(DATABASE_BACKUP_DIR, file_name),
+                            remote_prefix + file_name,
+                            connexion=connexion,
+                            progress=False,
+                        )
+                        in_flight[future] = (file_name, stat)
+                previous = current
+
+                if finished and not in_flight:
+                    break
+                if finished:
+                    wait(in_flight)
+                else:
+                    time.sleep(DUMP_POLL_INTERVAL)
+                for future in [future for future in in_flight if future.done()]:
+                    file_name, stat = in_flight.pop(future)
+                    future.result()
+                    uploaded[file_name] = stat
+                    print(f"Uploaded {remote_prefix}{file_name}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+        return_code = process.wait()
+    return uploaded, return_code
+
+
+def dump_directory_to_online_backup(date=None):
+    """
+    Dump with pg_dump --jobs in directory format and upload files as they are written.
+
+    A file is uploaded once it did not change for DUMP_POLL_INTERVAL, and
+    uploaded again if it changed after that by the time pg_dump exits.
+    """
+    from .chunks import put_manifest
+
+    connexion = boto_client(BackupType.MAIN)
+    manifest_key = db_name(date)
+    remote_prefix = _directory_prefix(manifest_key)
+    shutil.rmtree(DATABASE_BACKUP_DIR, ignore_errors=True)
+    shell_cmd = postgres_dump_command(DATABASE_BACKUP_DIR)
+    process = subprocess.Popen(shell_cmd, shell=True, env=_postgres_env())
+
+    try:
+        uploaded, return_code = _upload_dump_directory(
+            process, connexion, remote_prefix
+        )
+        if return_code:
+            raise subprocess.CalledProcessError(return_code, shell_cmd)
+        files = [[file_name, stat[0]] for file_name, stat in sorted(uploaded.items())]
+        put_manifest(
+            connexion, manifest_key, {"format": "pg_directory", "files": files}
+        )
+    except BaseException:
+        # the uploaded files are an incomplete dump, do not keep them, including
+        # the ones whose upload finished after the error
+        remote_keys = [
+            obj.key for obj in iter_objects(connexion, BUCKET, remote_prefix)
+        ]
+        delete_keys(connexion, BUCKET, remote_keys)
+        raise
+    finally:
+        shutil.rmtree(DATABASE_BACKUP_DIR, ignore_errors=True)
+
+    record_backup(connexion, manifest_key, FILE_FORMAT, DATABASE_BACKUP_TYPE)
+
+
+def download_directory_database(connexion, manifest_key):
+    """Download the files of a directory format dump in parallel."""
+    from .chunks import get_manifest
+
+    manifest = get_manifest(connexion, manifest_key)
+    remote_prefix = _directory_prefix(manifest_key)
+    shutil.rmtree(DATABASE_BACKUP_DIR, ignore_errors=True)
+    os.makedirs(DATABASE_BACKUP_DIR)
+
+    def download(file_name):
+        download_file(
+            connexion,
+            BUCKET,
+            remote_prefix + file_name,
+            os.path.join(DATABASE_BACKUP_DIR, file_name),
+            progress=False,
+        )
+
+    file_names = [file_name for file_name, size in manifest["files"]]
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_N_WORKERS) as executor:
+        for _ in tqdm(
+            executor.map(download, file_names),
+            total=len(file_names),
+            desc="Downloading dump",
+            unit="file",
+        ):
+            pass
+
+
+def delete_keys(connexion, bucket, keys):
+    """
+    Delete keys with DeleteObjects, in parallel batches of DELETE_BATCH_SIZE keys.
+
+    Return the deleted keys and the errors by key.
+    """
+    keys = list(keys)
+    batches = [
+        keys[start : start + DELETE_BATCH_SIZE]
+        for start in range(0, len(keys), DELETE_BATCH_SIZE)
+    ]
+
+    def delete_batch(batch):
+        try:
+            response = connexion.delete_objects(
+                Bucket=bucket,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
             )
+        except ClientError as e:
+            return [], {key: str(e) for key in batch}
+        errors = {
+            error["Key"]: f"{error.get('Code')}: {error.get('Message')}"
+            for error in response.get("Errors", [])
+        }
+        return [key for key in batch if key not in errors], errors
 
-        if db_password:
-            env = os.environ.copy()
-            env["PGPASSWORD"] = db_password
-            subprocess.check_output(shell_cmd, shell=True, env=env)
-        else:
-            subprocess.check_output(shell_cmd, shell=True)
-    else:
-        subprocess.check_output(SQLITE_DUMP_COMMAND, shell=True)
+    deleted, errors = [], {}
+    with ThreadPoolExecutor(max_workers=DELETE_N_WORKERS) as executor:
+        for batch_deleted, batch_errors in executor.map(delete_batch, batches):
+            deleted.extend(batch_deleted)
+            errors.update(batch_errors)
+
+    for key, error in errors.items():
+        print(f"error removing {key}, ignoring ({error})")
+    return deleted, errors
 
 
 def remove_old_database_files():
@@ -194,26 +971,108 @@ def remove_old_database_files():
 
     now = datetime.datetime.now()
 
+    old_keys = []
     for backup in backups:
-        try:
-            if (now - backup["date"]).total_seconds() > KEEP_N_DAYS * 3600 * 24:
-                print("removing old file {}".format(backup["key"]["Key"]))
-                connexion.delete_object(Bucket=BUCKET, Key=backup["key"]["Key"])
-            else:
-                print("keeping {}".format(backup["key"]["Key"]))
-        except ClientError:
-            print("error removing {}, ignoring".format(backup["key"]["Key"]))
+        if (now - backup["date"]).total_seconds() > KEEP_N_DAYS * 3600 * 24:
+            print("removing old file {}".format(backup["key"]["Key"]))
+            old_keys.append(backup["key"]["Key"])
+        else:
+            print("keeping {}".format(backup["key"]["Key"]))
+
+    old_files = []
+    has_old_manifests = any(key.endswith(MANIFEST_SUFFIX) for key in old_keys)
+    if IS_POSTGRES and has_old_manifests:
+        # directory format dumps are a manifest and the files of the dump
+        for key in old_keys:
+            if key.endswith(MANIFEST_SUFFIX):
+                old_files += [
+                    obj["Key"]
+                    for obj in _list_objects_paginated(
+                        connexion, BUCKET, _directory_prefix(key)
+                    )
+                ]
+
+    deleted, errors = delete_keys(connexion, BUCKET, old_files + old_keys)
+    remove_from_catalog(deleted)
+
+    if not IS_POSTGRES and (INCREMENTAL_DATABASE_BACKUP or has_old_manifests):
+        from .chunks import prune_chunks
+
+        # list the bucket rather than the catalog, so that no chunk still in use is removed
+        manifest_keys = [
+            backup["key"]["Key"]
+            for backup in get_backups(connexion, use_catalog=False)
+            if backup["key"]["Key"].endswith(MANIFEST_SUFFIX)
+        ]
+        prune_chunks(connexion, DATABASE_CHUNK_STORE, manifest_keys)
 
 
 def upload_to_online_backup(date=None):
     """Upload the database file online."""
-    backup_file(
-        file_path=DATABASE_BACKUP_FILE,
-        remote_key=db_name(date),
-        connexion=boto_client(BackupType.MAIN),
+    connexion = boto_client(BackupType.MAIN)
+    remote_key = db_name(date)
+    if INCREMENTAL_DATABASE_BACKUP:
+        upload_incremental_database(connexion, remote_key)
+    elif DATABASE_COMPRESSION:
+        with open(DATABASE_BACKUP_FILE, "rb") as fh:
+            upload_fileobj(
+                connexion,
+                compressed_reader(fh, DATABASE_COMPRESSION),
+                BUCKET,
+                remote_key,
+                size=os.path.getsize(DATABASE_BACKUP_FILE),
+            )
+    else:
+        backup_file(
+            file_path=DATABASE_BACKUP_FILE,
+            remote_key=remote_key,
+            connexion=connexion,
+        )
+    record_backup(connexion, remote_key, FILE_FORMAT, DATABASE_BACKUP_TYPE)
+
+
+def upload_incremental_database(connexion, remote_key):
+    """
+    Upload the SQLite backup as fixed-size page chunks and a manifest.
+
+    Chunks are addressed by their hash, so only the ones that changed since
+    a previous backup are uploaded.
+    """
+    from .chunks import ChunkUploader, put_manifest
+
+    chunks = []
+    with ChunkUploader(
+        connexion, DATABASE_CHUNK_STORE, DATABASE_COMPRESSION
+    ) as uploader:
+        with open(DATABASE_BACKUP_FILE, "rb") as fh:
+            for data in iter(lambda: fh.read(SQLITE_CHUNK_SIZE), b""):
+                chunks.append([uploader.add(data), len(data)])
+
+    put_manifest(
+        connexion,
+        remote_key,
+        {
+            "format": "sqlite_chunks",
+            "compression": DATABASE_COMPRESSION,
+            "chunks": chunks,
+        },
     )
 
 
+def download_incremental_database(connexion, manifest_key):
+    """Reassemble the SQLite backup from its manifest, fetching chunks in parallel."""
+    from .chunks import get_manifest, iter_chunks
+
+    manifest = get_manifest(connexion, manifest_key)
+    digests = [digest for digest, size in manifest["chunks"]]
+    chunks = iter_chunks(
+        connexion, DATABASE_CHUNK_STORE, manifest["compression"], digests
+    )
+    with open(DATABASE_BACKUP_FILE, "wb") as fh:
+        for data in tqdm(chunks, total=len(digests), desc="Downloading chunks"):
+            fh.write(data)
+
+
 def update_latest_backup():
     """Update the timestamp of the latest backup."""
     with open(LAST_BACKUP_FILE, "w") as fh:
@@ -230,33 +1089,102 @@ def get_latest_backup():
 
 def backup_database(date=None):
     """Backup the database."""
-    dump_database()
-    upload_to_online_backup(date)
+    if DIRECTORY_DATABASE_BACKUP:
+        dump_directory_to_online_backup(date)
+    elif IS_POSTGRES and STREAM_BACKUP:
+        stream_database_to_online_backup(date)
+    else:
+        dump_database()
+        upload_to_online_backup(date)
     remove_old_database_files()
     update_latest_backup()
 
 
-def delete_files(connexion=None, file_regex=None):
-    """Delete files matching a regex pattern."""
+def delete_files(connexion=None, file_regex=None, prefix=""):
+    """Delete files under prefix matching a regex pattern."""
     if connexion is None:
         connexion = boto_client()
 
     regex = re.compile(file_regex)
-    for backup_key in connexion.list_objects_v2(Bucket=BUCKET)["Contents"]:
-        if regex.match(backup_key["Key"]):
-            connexion.delete_object(Bucket=BUCKET, Key=backup_key["Key"])
+    deleted, errors = delete_keys(
+        connexion,
+        BUCKET,
+        (
+            backup_key["Key"]
+            for backup_key in _list_objects_paginated(connexion, BUCKET, prefix)
+            if regex.match(backup_key["Key"])
+        ),
+    )
+    remove_from_catalog(deleted)
+
 
+def backup_key(file_format, prefix, date):
+    """Remote key of a backup, under a date-partitioned prefix such as db/2026/10/."""
+    file_name = date.strftime(file_format)
+    if not prefix:
+        return file_name
+    return f"{prefix}/{date:%Y/%m}/{file_name}"
+
+
+def _backup_date(key, date_format):
+    """Date of a backup from its key, None if the key is not such a backup."""
+    file_name, compression = split_compression_suffix(key.rsplit("/", 1)[-1])
+    if file_name.endswith(MANIFEST_SUFFIX):
+        file_name = file_name[: -len(MANIFEST_SUFFIX)]
+    try:
+        return datetime.datetime.strptime(file_name, date_format)
+    except ValueError:
+        return None
+
+
+def get_backups(
+    connexion=None,
+    date_format=FILE_FORMAT,
+    prefix=DB_BACKUP_PREFIX,
+    use_catalog=USE_CATALOG,
+):
+    """
+    Get list of all backups with date and size information.
+
+    With use_catalog, backups are read from the local catalog, which is
+    synced from the bucket first if it does not exist yet.
+    """
+    if use_catalog:
+        backups = get_catalog_backups()
+        if backups is None:
+            sync_catalog(connexion)
+            backups = get_catalog_backups()
+        backups = [
+            backup
+            for backup in backups
+            if _backup_date(backup["key"]["Key"], date_format)
+            and (
+                "/" not in backup["key"]["Key"]
+                or backup["key"]["Key"].startswith(f"{prefix}/")
+            )
+        ]
+        return sorted(backups, key=lambda backup: backup["date"])
 
-def get_backups(connexion=None, date_format=FILE_FORMAT):
-    """Get list of all backups with date and size information."""
     if connexion is None:
         connexion = boto_client()
     backups = []
 
-    for backup_key in connexion.list_objects_v2(Bucket=BUCKET)["Contents"]:
-        try:
-            file_date = datetime.datetime.strptime(backup_key["Key"], date_format)
-        except ValueError:
+    # backups made before date-partitioned prefixes are at the bucket root
+    backup_objects = _list_objects_paginated(connexion, BUCKET, delimiter="/")
+    if prefix:
+        backup_objects += [
+            {
+                "Key": obj.key,
+                "Size": obj.size,
+                "ETag": obj.etag,
+                "LastModified": obj.last_modified,
+            }
+            for obj in iter_objects_sharded(connexion, BUCKET, f"{prefix}/")
+        ]
+
+    for backup_key in backup_objects:
+        file_date = _backup_date(backup_key["Key"], date_format)
+        if file_date is None:
             # is not a database backup
             continue
         backups.append({
@@ -270,21 +1198,77 @@ def get_backups(connexion=None, date_format=FILE_FORMAT):
     return backups
 
 
-def prepare_sql_dump(path, db_name, db_user):
-    """Prepare SQL dump for loading."""
-    import fileinput
-    import re
-    from django.db import connection
+def record_backup(connexion, key, date_format, backup_type):
+    """Add an uploaded backup to the local catalog."""
+    if not USE_CATALOG:
+        return
+    info = object_info(connexion, BUCKET, key)
+    add_to_catalog(
+        key,
+        _backup_date(key, date_format),
+        info["ContentLength"],
+        info["ETag"].strip('"'),
+        backup_type,
+    )
 
-    # transform dump to change owner
-    dump_file = fileinput.FileInput(path, inplace=True)
-    for line in dump_file:
-        line = re.sub(
-            "ALTER TABLE(.*)OWNER TO (.*);",
-            f"ALTER TABLE\\1OWNER TO {db_user};",
-            line.rstrip(),
+
+def sync_catalog(connexion=None):
+    """Rebuild the local backup catalog from the bucket."""
+    from .media_backup import (
+        ZIPPED_MEDIA_BACKUP_PREFIX,
+        ZIPPED_MEDIA_BACKUP_TYPE,
+        ZIPPED_MEDIA_FILE_FORMAT,
+    )
+
+    if connexion is None:
+        connexion = boto_client()
+
+    database_backups = get_backups(connexion, use_catalog=False)
+    zipped_media_backups = get_backups(
+        connexion,
+        ZIPPED_MEDIA_FILE_FORMAT,
+        ZIPPED_MEDIA_BACKUP_PREFIX,
+        use_catalog=False,
+    )
+    entries = replace_catalog(
+        [
+            (database_backups, DATABASE_BACKUP_TYPE),
+            (zipped_media_backups, ZIPPED_MEDIA_BACKUP_TYPE),
+        ]
+    )
+    print(f"Synced backup catalog with {len(entries)} backups")
+
+
+SQL_OWNER_REGEX = re.compile("ALTER TABLE(.*)OWNER TO (.*);")
+
+
+def rewrite_sql_owner(lines, db_user):
+    """Yield the lines of a SQL dump with table ownership given to db_user."""
+    in_copy_data = False
+    for line in lines:
+        if in_copy_data:
+            # rows of COPY blocks are data, and end with a \. line
+            in_copy_data = line.rstrip("\r\n") != "\\."
+            yield line
+            continue
+        in_copy_data = line.startswith("COPY ") and line.rstrip().endswith(
+            "FROM stdin;"
         )
-        print(line)
+        yield SQL_OWNER_REGEX.sub(f"ALTER TABLE\\1OWNER TO {db_user};", line)
+
+
+def _postgres_database_size():
+    """Size of the database on disk, an estimate of the size of its dump."""
+    from django.db import connection
+
+    with connection.cursor() as cursor:
+        cursor.execute("select pg_database_size(current_database());")
+        return cursor.fetchone()[0]
+
+
+def drop_public_tables():
+    """Drop all tables of the public schema before loading a SQL dump."""
+    from django.db import connection
 
     # list and remove all tables
     with connection.cursor() as cursor:
@@ -293,13 +1277,31 @@ def prepare_sql_dump(path, db_name, db_user):
         for (table,) in tables:
             cursor.execute(table)
 
+
+def prepare_sql_dump(path, db_name, db_user):
+    """Prepare SQL dump for loading."""
+    import fileinput
+
+    # transform dump to change owner
+    dump_file = fileinput.FileInput(path, inplace=True)
+    # only strip the newline, trailing tabs are empty values in COPY rows
+    for line in rewrite_sql_owner((line.rstrip("\n") for line in dump_file), db_user):
+        print(line)
+
+    drop_public_tables()
+
     shell_cmd = f"psql -d {db_name} -U {db_user} < {path} &> /dev/null"
     return (shell_cmd, f"Password for user {db_user}:")
 
 
 def prepare_compress_dump(path, db_name, db_user):
-    """Prepare compressed dump for loading."""
-    shell_cmd = f"pg_restore -U {db_user} --dbname {db_name} -v {path} --jobs {BACKUP_RECOVER_N_WORKERS} --clean --if-exists --no-owner --role={db_user}"
+    """Prepare compressed dump for loading, read from stdin if path is None."""
+    if path is None:
+        # parallel jobs need a seekable archive, which a pipe is not
+        source = ""
+    else:
+        source = f" {path} --jobs {BACKUP_RECOVER_N_WORKERS}"
+    shell_cmd = f"pg_restore -U {db_user} --dbname {db_name} -v{source} --clean --if-exists --no-owner --role={db_user}"
     return (shell_cmd, "Password:")
 
 
@@ -308,7 +1310,6 @@ def load_postgresql_dump(path):
     # load the dump
     db_name = settings.DATABASES["default"]["NAME"]
     db_user = settings.DATABASES["default"]["USER"]
-    db_password = settings.DATABASES["default"].get("PASSWORD")
 
     if COMPRESS_DATABASE_BACKUP:
         shell_cmd, expected_text = prepare_compress_dump(path, db_name, db_user)
@@ -317,12 +1318,59 @@ def load_postgresql_dump(path):
 
     print("command:", shell_cmd)
 
-    if db_password:
-       env = os.environ.copy()
-       env["PGPASSWORD"] = db_password
-       subprocess.check_output(shell_cmd, shell=True, env=env)
+    subprocess.check_output(shell_cmd, shell=True, env=_postgres_env())
+
+
+def stream_postgresql_dump(connexion, key):
+    """
+    Load PostgreSQL dump by piping the S3 object into pg_restore or psql.
+
+    Plain SQL dumps have their owner rewritten line by line on the way, so
+    nothing is written to disk and the restore starts right away.
+    """
+    db_name = settings.DATABASES["default"]["NAME"]
+    db_user = settings.DATABASES["default"]["USER"]
+    key_without_suffix, compression = split_compression_suffix(key)
+    body = decompressed_reader(
+        connexion.get_object(Bucket=BUCKET, Key=key)["Body"], compression
+    )
+
+    if COMPRESS_DATABASE_BACKUP:
+        shell_cmd, expected_text = prepare_compress_dump(None, db_name, db_user)
+        chunks = iter(lambda: body.read(READ_SIZE), b"")
+        output = None
     else:
-        subprocess.check_output(shell_cmd, shell=True)
+        drop_public_tables()
+        shell_cmd = f"psql -d {db_name} -U {db_user}"
+        lines = (line.decode() for line in body)
+        chunks = (line.encode() for line in rewrite_sql_owner(lines, db_user))
+        output = subprocess.DEVNULL
+
+    print("command:", shell_cmd)
+
+    process = subprocess.Popen(
+        shell_cmd,
+        shell=True,
+        stdin=subprocess.PIPE,
+        stdout=output,
+        stderr=output,
+        env=_postgres_env(),
+    )
+    try:
+        for chunk in chunks:
+            process.stdin.write(chunk)
+    except BrokenPipeError:
+        # the restore process exited early, its return code tells why
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        return_code = process.wait()
+
+    if return_code:
+        raise subprocess.CalledProcessError(return_code, shell_cmd)
 
 
 def recover_database(db_file=None):
@@ -334,16 +1382,39 @@ def recover_database(db_file=None):
     connexion = boto_client()
 
     if db_file is None or db_file == "latest":
-        backups = get_backups()
+        backups = get_backups(connexion)
         if not len(backups):
             raise ValueError("Could not find any backup")
         db_file = backups[-1]["key"]["Key"]
 
-    key = connexion.get_object(Bucket=BUCKET, Key=db_file)
-    if not key:
+    info = object_info(connexion, BUCKET, db_file)
+    if not info:
         raise ValueError(f"Wrong input file db {db_file}")
 
-    connexion.download_file(Bucket=BUCKET, Key=db_file, Filename=DATABASE_BACKUP_FILE)
+    if IS_POSTGRES and db_file.endswith(MANIFEST_SUFFIX):
+        download_directory_database(connexion, db_file)
+        load_postgresql_dump(DATABASE_BACKUP_DIR)
+        shutil.rmtree(DATABASE_BACKUP_DIR)
+        return
+
+    if IS_POSTGRES and STREAM_RECOVER:
+        stream_postgresql_dump(connexion, db_file)
+        return
+
+    key_without_suffix, compression = split_compression_suffix(db_file)
+    if db_file.endswith(MANIFEST_SUFFIX):
+        download_incremental_database(connexion, db_file)
+    elif compression:
+        compressed_file = DATABASE_BACKUP_FILE + compression_suffix(compression)
+        download_file(connexion, BUCKET, db_file, compressed_file, info=info)
+        with open(compressed_file, "rb") as source:
+            with open(DATABASE_BACKUP_FILE, "wb") as destination:
+                shutil.copyfileobj(
+                    decompressed_reader(source, compression), destination, READ_SIZE
+                )
+        os.remove(compressed_file)
+    else:
+        download_file(connexion, BUCKET, db_file, DATABASE_BACKUP_FILE, info=info)
 
     if IS_POSTGRES:
         load_postgresql_dump(DATABASE_BACKUP_FILE)
@@ -356,9 +1427,9 @@ def recover_database(db_file=None):
     os.remove(DATABASE_BACKUP_FILE)
 
 
-def list_backups(date_format):
+def list_backups(date_format, prefix=DB_BACKUP_PREFIX):
     """List backups with a specific date format and human-readable sizes."""
-    backups = get_backups(date_format=date_format)
+    backups = get_backups(date_format=date_format, prefix=prefix)
 
     for backup in backups:
         size_human = humanize.naturalsize(backup["size"], binary=True)
@@ -374,4 +1445,7 @@ def db_name(date=None) -> str:
     """Generate filename for database backup."""
     if date is None:
         date = datetime.datetime.now()
-    return date.strftime(FILE_FORMAT)
+    remote_key = backup_key(FILE_FORMAT, DB_BACKUP_PREFIX, date)
+    if INCREMENTAL_DATABASE_BACKUP or DIRECTORY_DATABASE_BACKUP:
+        return remote_key + MANIFEST_SUFFIX
+    return remote_key + compression_suffix(DATABASE_COMPRESSION)
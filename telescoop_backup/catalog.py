@@ -0,0 +1,100 @@
+import datetime
+import json
+import os
+import threading
+
+from django.conf import settings
+
+
+# Catalog settings
+USE_CATALOG = getattr(settings, "BACKUP_CATALOG", False)
+CATALOG_FILE = os.path.join(settings.BASE_DIR, ".telescoop_backup_catalog.json")
+
+_catalog_lock = threading.Lock()
+
+
+def _load_catalog():
+    """Load catalog entries by key, None if there is no catalog for this bucket."""
+    if not os.path.isfile(CATALOG_FILE):
+        return None
+    with open(CATALOG_FILE, "r") as fh:
+        catalog = json.load(fh)
+    if catalog.get("bucket") != settings.BACKUP_BUCKET:
+        return None
+    return catalog["backups"]
+
+
+def _save_catalog(entries):
+    """Atomically write catalog entries."""
+    tmp_file = f"{CATALOG_FILE}.tmp"
+    with open(tmp_file, "w") as fh:
+        json.dump({"bucket": settings.BACKUP_BUCKET, "backups": entries}, fh)
+    os.replace(tmp_file, CATALOG_FILE)
+
+
+def _entry(date, size, checksum, backup_type):
+    return {
+        "date": date.isoformat(),
+        "size": size,
+        "checksum": checksum,
+        "type": backup_type,
+    }
+
+
+def get_catalog_backups():
+    """
+    Get backups from the catalog, None if it must be synced from the bucket first.
+
+    Backups are returned in the format of `backup.get_backups`.
+    """
+    with _catalog_lock:
+        entries = _load_catalog()
+    if entries is None:
+        return None
+    return [
+        {
+            "key": {"Key": key, "Size": entry["size"], "ETag": entry["checksum"]},
+            "date": datetime.datetime.fromisoformat(entry["date"]),
+            "size": entry["size"],
+            "type": entry["type"],
+        }
+        for key, entry in entries.items()
+    ]
+
+
+def add_to_catalog(key, date, size, checksum, backup_type):
+    """Record an uploaded backup in the catalog."""
+    with _catalog_lock:
+        entries = _load_catalog()
+        if entries is None:
+            # the next lookup syncs the whole catalog, including this backup
+            return
+        entries[key] = _entry(date, size, checksum, backup_type)
+        _save_catalog(entries)
+
+
+def remove_from_catalog(keys):
+    """Forget deleted backups."""
+    with _catalog_lock:
+        entries = _load_catalog()
+        if entries is None:
+            return
+        for key in keys:
+            entries.pop(key, None)
+        _save_catalog(entries)
+
+
+def replace_catalog(backups):
+    """Replace the catalog with (backups, backup_type) listed from the bucket."""
+    entries = {}
+    for backup_list, backup_type in backups:
+        for backup in backup_list:
+            entries[backup["key"]["Key"]] = _entry(
+                backup["date"],
+                backup["size"],
+                backup["key"].get("ETag", "").strip('"'),
+                backup_type,
+            )
+    with _catalog_lock:
+        _save_catalog(entries)
+    return entries
@@ -0,0 +1,210 @@
+import collections
+import datetime
+import hashlib
+import json
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import humanize
+from django.conf import settings
+
+from .backup import BUCKET, _list_objects_paginated, delete_keys
+from .compression import (
+    compress_bytes,
+    compression_suffix,
+    decompress_bytes,
+    split_compression_suffix,
+)
+from .transfer import DOWNLOAD_N_WORKERS, MAX_CONCURRENCY
+
+
+# Chunk store settings
+CHUNK_PREFIX = getattr(settings, "BACKUP_CHUNK_PREFIX", "chunks")
+CDC_MIN_SIZE = getattr(settings, "BACKUP_CDC_MIN_SIZE", 256 * 1024)
+CDC_AVERAGE_SIZE = getattr(settings, "BACKUP_CDC_AVERAGE_SIZE", 1024**2)
+CDC_MAX_SIZE = getattr(settings, "BACKUP_CDC_MAX_SIZE", 4 * 1024**2)
+# unreferenced chunks younger than this may belong to a backup in progress
+CHUNK_PRUNE_GRACE_PERIOD = datetime.timedelta(days=1)
+
+# random 64 bits values by byte for the gear rolling hash
+_GEAR_TABLE = [
+    int.from_bytes(hashlib.sha256(bytes([byte])).digest()[:8], "big")
+    for byte in range(256)
+]
+_HASH_MASK = 2**64 - 1
+
+
+def _store_prefix(store):
+    return f"{CHUNK_PREFIX}/{store}/"
+
+
+def chunk_key(store, digest, compression=None):
+    """Remote key of a chunk, content addressed by its sha256 digest."""
+    suffix = compression_suffix(compression)
+    return f"{_store_prefix(store)}{digest[:2]}/{digest}{suffix}"
+
+
+class ChunkUploader:
+    """
+    Upload chunks that are not in the store yet, with a pool of threads.
+
+    Use as a context manager, `add` returns the digest to record in the
+    manifest and the upload of new chunks happens in the background.
+    """
+
+    def __init__(self, connexion, store, compression=None, n_workers=MAX_CONCURRENCY):
+        self.connexion = connexion
+        self.store = store
+        self.compression = compression
+        self.n_workers = n_workers
+        self.n_chunks = 0
+        self.n_uploaded = 0
+        self.uploaded_size = 0
+        self._existing_keys = {
+            obj["Key"]
+            for obj in _list_objects_paginated(connexion, BUCKET, _store_prefix(store))
+        }
+        self._executor = None
+        self._in_flight = set()
+
+    def __enter__(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.n_workers)
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if exc_info[0] is None:
+                self._wait(0)
+        finally:
+            self._executor.shutdown(wait=True)
+        size_human = humanize.naturalsize(self.uploaded_size, binary=True)
+        print(
+            f"Uploaded {self.n_uploaded} new chunks out of {self.n_chunks} ({size_human})"
+        )
+
+    def _wait(self, max_in_flight):
+        while len(self._in_flight) > max_in_flight:
+            done, self._in_flight = wait(self._in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                # raise upload errors
+                future.result()
+
+    def _upload(self, key, data):
+        self.connexion.put_object(
+            Bucket=BUCKET, Key=key, Body=compress_bytes(data, self.compression)
+        )
+
+    def add(self, data):
+        """Schedule the upload of a chunk if the store does not have it yet."""
+        digest = hashlib.sha256(data).hexdigest()
+        key = chunk_key(self.store, digest, self.compression)
+        self.n_chunks += 1
+        if key not in self._existing_keys:
+            self._existing_keys.add(key)
+            # bound the memory held by chunks waiting for upload
+            self._wait(2 * self.n_workers)
+            self._in_flight.add(self._executor.submit(self._upload, key, data))
+            self.n_uploaded += 1
+            self.uploaded_size += len(data)
+        return digest
+
+
+def _cut_point(data):
+    """Length of the first content-defined chunk of data."""
+    end = min(len(data), CDC_MAX_SIZE)
+    if end <= CDC_MIN_SIZE:
+        return end
+    # a boundary is found when the top bits of the hash are all zeros,
+    # which happens once every CDC_AVERAGE_SIZE bytes on average
+    shift = 64 - (CDC_AVERAGE_SIZE.bit_length() - 1)
+    gear_table = _GEAR_TABLE
+    rolling_hash = 0
+    for position in range(CDC_MIN_SIZE, end):
+        rolling_hash = ((rolling_hash << 1) + gear_table[data[position]]) & _HASH_MASK
+        if not rolling_hash >> shift:
+            return position + 1
+    return end
+
+
+def content_defined_chunks(fileobj):
+    """
+    Split a stream into chunks whose boundaries depend on their content.
+
+    An insertion or deletion only changes the chunks around it, so the
+    other chunks keep their hash and are deduplicated. The rolling hash is
+    computed in Python, at a few MiB/s, so it is only worth it for large
+    files that are edited in place.
+    """
+    buffer = b""
+    eof = False
+    while not eof:
+        data = fileobj.read(CDC_MAX_SIZE)
+        eof = not data
+        buffer += data
+        while buffer and (eof or len(buffer) >= CDC_MAX_SIZE):
+            cut = _cut_point(buffer)
+            yield buffer[:cut]
+            buffer = buffer[cut:]
+
+
+def fixed_size_chunks(fileobj, size=CDC_MAX_SIZE):
+    """Split a stream into chunks of size bytes, a single one for smaller files."""
+    return iter(lambda: fileobj.read(size), b"")
+
+
+def iter_chunks(connexion, store, compression, digests, n_workers=DOWNLOAD_N_WORKERS):
+    """Fetch chunks with a pool of threads, yielding their data in order."""
+
+    def fetch(digest):
+        body = connexion.get_object(
+            Bucket=BUCKET, Key=chunk_key(store, digest, compression)
+        )["Body"]
+        data = decompress_bytes(body.read(), compression)
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"Chunk {digest} is corrupted")
+        return data
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = collections.deque()
+        for digest in digests:
+            pending.append(executor.submit(fetch, digest))
+            if len(pending) >= 2 * n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def put_manifest(connexion, key, manifest):
+    """Upload the manifest of a chunked backup."""
+    connexion.put_object(Bucket=BUCKET, Key=key, Body=json.dumps(manifest).encode())
+
+
+def get_manifest(connexion, key):
+    """Download the manifest of a chunked backup."""
+    return json.loads(connexion.get_object(Bucket=BUCKET, Key=key)["Body"].read())
+
+
+def _manifest_digests(manifest):
+    """Digests of all the chunks referenced by a manifest."""
+    chunk_lists = [manifest.get("chunks", [])]
+    chunk_lists += [entry["chunks"] for entry in manifest.get("files", {}).values()]
+    return {digest for chunk_list in chunk_lists for digest, size in chunk_list}
+
+
+def prune_chunks(connexion, store, manifest_keys):
+    """Delete chunks of the store that none of the given manifests reference."""
+    referenced = set()
+    for manifest_key in manifest_keys:
+        referenced |= _manifest_digests(get_manifest(connexion, manifest_key))
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    unreferenced = []
+    for obj in _list_objects_paginated(connexion, BUCKET, _store_prefix(store)):
+        digest, compression = split_compression_suffix(obj["Key"].rsplit("/", 1)[-1])
+        if digest in referenced:
+            continue
+        if now - obj["LastModified"] < CHUNK_PRUNE_GRACE_PERIOD:
+            continue
+        unreferenced.append(obj["Key"])
+
+    print(f"Removing {len(unreferenced)} unreferenced chunks from {store} store")
+    delete_keys(connexion, BUCKET, unreferenced)
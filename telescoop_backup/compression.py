@@ -0,0 +1,152 @@
+import importlib
+import io
+import zlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+# Compression settings
+COMPRESSION = getattr(settings, "BACKUP_COMPRESSION", None)
+COMPRESSION_LEVEL = getattr(settings, "BACKUP_COMPRESSION_LEVEL", None)
+COMPRESSION_THREADS = getattr(settings, "BACKUP_COMPRESSION_THREADS", 0)
+
+COMPRESSION_SUFFIXES = {"zstd": ".zst", "gzip": ".gz", "lz4": ".lz4"}
+READ_SIZE = 1024**2
+
+
+def _import_module(module_name, package_name):
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        raise ImproperlyConfigured(
+            f"{package_name} must be installed to use this BACKUP_COMPRESSION"
+        )
+
+
+class _Lz4Compressor:
+    """lz4 frame compressor with the compress/flush interface of zlib."""
+
+    def __init__(self, lz4_frame):
+        self._compressor = lz4_frame.LZ4FrameCompressor(
+            compression_level=COMPRESSION_LEVEL or 0
+        )
+        self._started = False
+
+    def _begin(self):
+        if self._started:
+            return b""
+        self._started = True
+        return self._compressor.begin()
+
+    def compress(self, data):
+        return self._begin() + self._compressor.compress(data)
+
+    def flush(self):
+        return self._begin() + self._compressor.flush()
+
+
+def _compressor(algorithm):
+    """Compressor with compress(data) and flush() methods for the algorithm."""
+    if algorithm == "gzip":
+        level = COMPRESSION_LEVEL if COMPRESSION_LEVEL is not None else 6
+        # wbits=31 produces a gzip header and trailer
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    if algorithm == "zstd":
+        zstandard = _import_module("zstandard", "zstandard")
+        return zstandard.ZstdCompressor(
+            level=COMPRESSION_LEVEL or 3, threads=COMPRESSION_THREADS
+        ).compressobj()
+    if algorithm == "lz4":
+        return _Lz4Compressor(_import_module("lz4.frame", "lz4"))
+    raise ImproperlyConfigured(f"Unknown BACKUP_COMPRESSION {algorithm}")
+
+
+def _decompressor(algorithm):
+    """Decompressor with a decompress(data) method for the algorithm."""
+    if algorithm == "gzip":
+        return zlib.decompressobj(31)
+    if algorithm == "zstd":
+        zstandard = _import_module("zstandard", "zstandard")
+        return zstandard.ZstdDecompressor().decompressobj()
+    if algorithm == "lz4":
+        lz4_frame = _import_module("lz4.frame", "lz4")
+        return lz4_frame.LZ4FrameDecompressor()
+    raise ImproperlyConfigured(f"Unknown backup compression {algorithm}")
+
+
+class _TransformReader(io.RawIOBase):
+    """Readable stream applying a transform to the data read from another stream."""
+
+    def __init__(self, fileobj, transform=None, finish=None):
+        self._fileobj = fileobj
+        self._transform = transform
+        self._finish = finish
+        self._buffer = bytearray()
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer and not self._eof:
+            data = self._fileobj.read(READ_SIZE)
+            if data:
+                self._buffer += self._transform(data) if self._transform else data
+            else:
+                self._eof = True
+                if self._finish:
+                    self._buffer += self._finish()
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        del self._buffer[:size]
+        return size
+
+
+def compression_suffix(algorithm):
+    """Key suffix recording the compression of a backup."""
+    if not algorithm:
+        return ""
+    if algorithm not in COMPRESSION_SUFFIXES:
+        raise ImproperlyConfigured(f"Unknown BACKUP_COMPRESSION {algorithm}")
+    return COMPRESSION_SUFFIXES[algorithm]
+
+
+def split_compression_suffix(key):
+    """Split a key into the key without compression suffix and the algorithm."""
+    for algorithm, suffix in COMPRESSION_SUFFIXES.items():
+        if key.endswith(suffix):
+            return key[: -len(suffix)], algorithm
+    return key, None
+
+
+def compressed_reader(fileobj, algorithm):
+    """Stream of the compressed content of fileobj."""
+    compressor = _compressor(algorithm)
+    return io.BufferedReader(
+        _TransformReader(fileobj, compressor.compress, compressor.flush),
+        buffer_size=READ_SIZE,
+    )
+
+
+def decompressed_reader(fileobj, algorithm):
+    """Stream of the decompressed content of fileobj, as is if algorithm is None."""
+    transform = _decompressor(algorithm).decompress if algorithm else None
+    return io.BufferedReader(
+        _TransformReader(fileobj, transform), buffer_size=READ_SIZE
+    )
+
+
+def compress_bytes(data, algorithm):
+    """Compress data in memory, as is if algorithm is None."""
+    if not algorithm:
+        return data
+    compressor = _compressor(algorithm)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_bytes(data, algorithm):
+    """Decompress data in memory, as is if algorithm is None."""
+    if not algorithm:
+        return data
+    return _decompressor(algorithm).decompress(data)
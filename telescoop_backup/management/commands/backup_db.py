@@ -7,6 +7,7 @@ from telescoop_backup.backup import (
     backup_database,
     list_saved_databases,
     recover_database,
+    sync_catalog,
 )
 from telescoop_backup.media_backup import (
     backup_media,
@@ -26,20 +27,24 @@ COMMAND_HELP = """
 usage:
      `python backup_db.py backup`
          to back up current db
-  or `python backup_db backup_db_and_media [--overwrite]
-         to back up current db with the media (optionally with --overwrite to overwrite existing files)
+  or `python backup_db backup_db_and_media [--overwrite] [--diff]
+         to back up current db with the media (optionally with --overwrite to overwrite existing files,
+         or --diff to copy files that changed since the last security backup)
   or `python backup_db backup_media --zipped
          to back up current media in a zipped file
   or `python backup_db.py list`
          to list already backed up files
+  or `python backup_db.py sync_catalog`
+         to rebuild the local backup catalog from the bucket
   or `python backup_db.py recover xx_db@YYYY-MM-DDTHH:MM.sqlite`
          to recover from specific file
-  or `python backup_db.py recover_media
-         to recover the media
-  or `python backup_db.py recover_db_and_media
+  or `python backup_db.py recover_media [--path PATH]...
+         to recover the media (optionally only the files matching the glob patterns or folders PATH)
+  or `python backup_db.py recover_db_and_media [--path PATH]...
          to recover the media and the db
-  or `python backup_db.py security_backup [--overwrite]
-         to create a security backup (optionally with --overwrite to overwrite existing files)
+  or `python backup_db.py security_backup [--overwrite] [--diff]
+         to create a security backup (optionally with --overwrite to overwrite existing files,
+         or --diff to copy files that changed since the last security backup)
   or `python backup_db.py restore_security_backup [--overwrite]
          to restore files from security backup to first backup (optionally with --overwrite to overwrite existing files)
 """
@@ -78,11 +83,22 @@ class Command(BaseCommand):
             action="store_true",
             help="use this to have zipped media files",
         )
+        parser.add_argument(
+            "--path",
+            action="append",
+            dest="paths",
+            help="if action is `recover_media`, glob pattern or folder of the media to recover, can be repeated",
+        )
         parser.add_argument(
             "--overwrite",
             action="store_true",
             help="overwrite existing files in the security backup (default: False)",
         )
+        parser.add_argument(
+            "--diff",
+            action="store_true",
+            help="copy files whose size or ETag changed to the security backup (default: False)",
+        )
 
     def _handle_internal(self, *args, **options):
         if not options["action"]:
@@ -98,10 +114,14 @@ class Command(BaseCommand):
                 backup_media()
         elif options["action"] == "backup_db_and_media":
             backup_database_and_media(
-                zipped_media=is_zipped, overwrite=options.get("overwrite", False)
+                zipped_media=is_zipped,
+                overwrite=options.get("overwrite", False),
+                diff=options.get("diff", False),
             )
         elif options["action"] == "list":
             list_saved_databases()
+        elif options["action"] == "sync_catalog":
+            sync_catalog()
         elif options["action"] == "list_media":
             if is_zipped:
                 list_saved_zipped_media()
@@ -115,15 +135,18 @@ class Command(BaseCommand):
         elif options["action"] == "recover_media":
             file_media = options.get("file_media")
             if is_zipped:
-                recover_zipped_media(file_media)
+                recover_zipped_media(file_media, options.get("paths"))
             else:
                 self.not_implemented()
         elif options["action"] == "recover_db_and_media":
             file_media = options.get("file_media")
             db_file = options.get("file")
-            recover_database_and_media(file_media, db_file)
+            recover_database_and_media(file_media, db_file, options.get("paths"))
         elif options["action"] == "security_backup":
-            security_backup(overwrite=options.get("overwrite", False))
+            security_backup(
+                overwrite=options.get("overwrite", False),
+                diff=options.get("diff", False),
+            )
         elif options["action"] == "restore_security_backup":
             restore_security_backup(overwrite=options.get("overwrite", False))
         else:
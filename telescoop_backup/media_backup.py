@@ -1,62 +1,416 @@
 import datetime
+import fnmatch
 import os
 import shutil
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
+from tqdm import tqdm
 
 from .backup import (
     boto_client,
     BackupType,
-    backup_file,
     backup_folder,
+    backup_key,
     get_backups,
+    record_backup,
     BUCKET,
     DATE_FORMAT,
+    MANIFEST_SUFFIX,
+)
+from .transfer import (
+    DOWNLOAD_N_WORKERS,
+    MULTIPART_CHUNK_SIZE,
+    object_info,
+    open_range_reader,
+    upload_fileobj,
 )
 
 
 # Media backup settings
-ZIPPED_BACKUP_FILE = os.path.join(settings.BASE_DIR, "media.zip")
 ZIPPED_MEDIA_FILE_FORMAT = f"{DATE_FORMAT}_media.zip"
+ZIPPED_MEDIA_BACKUP_TYPE = "zipped_media"
+ZIPPED_MEDIA_BACKUP_PREFIX = getattr(
+    settings, "BACKUP_ZIPPED_MEDIA_PREFIX", "zipped_media"
+)
+INCREMENTAL_MEDIA_BACKUP = getattr(settings, "BACKUP_MEDIA_INCREMENTAL", False)
+MEDIA_MANIFEST_FILE = os.path.join(
+    settings.BASE_DIR, ".telescoop_backup_media_manifest.json"
+)
+# media that is already compressed is stored as is in zipped backups
+ZIP_STORED_EXTENSIONS = getattr(
+    settings,
+    "BACKUP_ZIP_STORED_EXTENSIONS",
+    {
+        ".jpg",
+        ".jpeg",
+        ".png",
+        ".gif",
+        ".webp",
+        ".avif",
+        ".mp3",
+        ".mp4",
+        ".m4a",
+        ".mov",
+        ".webm",
+        ".ogg",
+        ".pdf",
+        ".zip",
+        ".gz",
+        ".zst",
+        ".docx",
+        ".xlsx",
+        ".pptx",
+        ".odt",
+    },
+)
+DEDUPLICATED_MEDIA_BACKUP = getattr(settings, "BACKUP_MEDIA_DEDUP", False)
+MEDIA_CHUNK_STORE = "media"
 
 
 def backup_media():
     """Backup media folder to remote storage."""
     media_folder = settings.MEDIA_ROOT
-    backup_folder(media_folder, "media")
+    manifest_file = MEDIA_MANIFEST_FILE if INCREMENTAL_MEDIA_BACKUP else None
+    backup_folder(media_folder, "media", manifest_file=manifest_file)
 
 
 def backup_zipped_media(date=None):
     """Backup media folder as a zipped archive."""
+    if DEDUPLICATED_MEDIA_BACKUP:
+        backup_deduplicated_media(date)
+        return
+
+    connexion = boto_client(BackupType.MAIN)
+    remote_key = zipped_media_file_name(date)
+    stream_zip_to_online_backup(connexion, settings.MEDIA_ROOT, remote_key)
+    record_backup(
+        connexion, remote_key, ZIPPED_MEDIA_FILE_FORMAT, ZIPPED_MEDIA_BACKUP_TYPE
+    )
+
+
+def _compress_type(file_name):
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension in ZIP_STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def write_zip(folder, fileobj):
+    """Write a zip archive of folder to a stream, that does not need to be seekable."""
+    with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED) as archive:
+        for root, dirs, file_names in os.walk(folder):
+            dirs.sort()
+            if root != folder:
+                archive.write(root, os.path.relpath(root, start=folder))
+            for file in sorted(file_names):
+                file_path = os.path.join(root, file)
+                archive.write(
+                    file_path,
+                    os.path.relpath(file_path, start=folder),
+                    compress_type=_compress_type(file),
+                )
+
+
+def _folder_size(folder):
+    """Total size of the files of a folder."""
+    return sum(
+        os.path.getsize(os.path.join(root, file))
+        for root, dirs, file_names in os.walk(folder)
+        for file in file_names
+    )
+
+
+def stream_zip_to_online_backup(connexion, folder, remote_key):
+    """
+    Zip folder straight into a multipart upload.
+
+    The archive is written by a thread into a pipe that the upload reads
+    from, so it is never written to disk.
+    """
+    # the archive is about the size of the files, smaller when compressed
+    size = _folder_size(folder)
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def archive():
+        try:
+            with open(write_fd, "wb") as fh:
+                write_zip(folder, fh)
+        except BaseException as e:
+            errors.append(e)
+
+    writer = threading.Thread(target=archive, daemon=True)
+    writer.start()
+    with open(read_fd, "rb") as fh:
+        try:
+            upload_fileobj(connexion, fh, BUCKET, remote_key, size=size)
+        finally:
+            # closing the pipe stops the writer if the upload failed
+            fh.close()
+            writer.join()
+
+    if errors:
+        # the uploaded object is a truncated archive, do not keep it
+        connexion.delete_object(Bucket=BUCKET, Key=remote_key)
+        raise errors[0]
+
+
+def _media_chunks(fileobj, file_name, size):
+    """
+    Chunks of a media file for a deduplicated snapshot.
+
+    Content-defined chunking is slow, so it is only used for large files
+    that may be edited in place. Small files are a single chunk, and
+    already compressed media, which is not edited, is cut in fixed-size
+    chunks.
+    """
+    from .chunks import CDC_MAX_SIZE, content_defined_chunks, fixed_size_chunks
+
+    if size <= CDC_MAX_SIZE or _compress_type(file_name) == zipfile.ZIP_STORED:
+        return fixed_size_chunks(fileobj)
+    return content_defined_chunks(fileobj)
+
+
+def backup_deduplicated_media(date=None):
+    """
+    Backup media folder as a deduplicated snapshot.
+
+    Files are split into chunks that are stored once in the media chunk
+    store, and the snapshot is a manifest of the chunks of each file. Files
+    unchanged since the previous snapshot are not read again.
+    """
+    from .chunks import ChunkUploader, get_manifest, put_manifest
+
+    connexion = boto_client(BackupType.MAIN)
     media_folder = settings.MEDIA_ROOT
-    filename, extension = ZIPPED_BACKUP_FILE.split(".")
-    shutil.make_archive(filename, extension, media_folder)
 
-    backup_file(ZIPPED_BACKUP_FILE, zipped_media_file_name(date))
-    os.remove(ZIPPED_BACKUP_FILE)
+    previous_files = {}
+    snapshots = [
+        backup
+        for backup in get_backups(
+            connexion, ZIPPED_MEDIA_FILE_FORMAT, ZIPPED_MEDIA_BACKUP_PREFIX
+        )
+        if backup["key"]["Key"].endswith(MANIFEST_SUFFIX)
+    ]
+    if snapshots:
+        previous_files = get_manifest(connexion, snapshots[-1]["key"]["Key"])["files"]
 
+    files = {}
+    with ChunkUploader(connexion, MEDIA_CHUNK_STORE) as uploader:
+        for root, dirs, file_names in os.walk(media_folder):
+            for file in file_names:
+                file_path = os.path.join(root, file)
+                relative_path = os.path.relpath(file_path, start=media_folder)
+                relative_path = relative_path.replace(os.sep, "/")
+                stat = os.stat(file_path)
+                previous = previous_files.get(relative_path)
+                if previous and (previous["size"], previous["mtime_ns"]) == (
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                ):
+                    files[relative_path] = previous
+                    continue
 
-def recover_zipped_media(file_name=None):
-    """Recover media from a zipped backup."""
+                with open(file_path, "rb") as fh:
+                    chunks = [
+                        [uploader.add(data), len(data)]
+                        for data in _media_chunks(fh, file, stat.st_size)
+                    ]
+                files[relative_path] = {
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "chunks": chunks,
+                }
+
+    remote_key = zipped_media_file_name(date)
+    put_manifest(
+        connexion,
+        remote_key,
+        {"format": "media_chunks", "compression": None, "files": files},
+    )
+    record_backup(
+        connexion, remote_key, ZIPPED_MEDIA_FILE_FORMAT, ZIPPED_MEDIA_BACKUP_TYPE
+    )
+
+
+def recover_deduplicated_media(connexion, manifest_key, paths=None):
+    """
+    Recover media from a deduplicated snapshot, fetching chunks in parallel.
+
+    Only files matching paths are recovered if given, and files with the
+    size and modification time of the snapshot are skipped.
+    """
+    from .chunks import get_manifest, iter_chunks
+
+    manifest = get_manifest(connexion, manifest_key)
+    entries = [
+        (relative_path, entry)
+        for relative_path, entry in sorted(manifest["files"].items())
+        if not paths or _matches(relative_path, paths)
+    ]
+    if paths and not entries:
+        raise ValueError(f"No file matching {', '.join(paths)} in {manifest_key}")
+
+    files = []
+    n_up_to_date = 0
+    for relative_path, entry in entries:
+        file_path = _member_path(relative_path)
+        if os.path.isfile(file_path):
+            stat = os.stat(file_path)
+            if (stat.st_size, stat.st_mtime_ns) == (entry["size"], entry["mtime_ns"]):
+                n_up_to_date += 1
+                continue
+        files.append((relative_path, entry))
+    print(f"{n_up_to_date} files are already up to date")
+    digests = [
+        digest for relative_path, entry in files for digest, size in entry["chunks"]
+    ]
+    chunks = iter_chunks(connexion, MEDIA_CHUNK_STORE, manifest["compression"], digests)
+
+    for relative_path, entry in tqdm(files, desc="Recovering media", unit="file"):
+        file_path = _member_path(relative_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as fh:
+            for _ in entry["chunks"]:
+                fh.write(next(chunks))
+        os.utime(file_path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+
+
+def _matches(name, paths):
+    """Whether an archive member matches one of the glob patterns or folders."""
+    return any(
+        fnmatch.fnmatch(name, path) or name.startswith(path.rstrip("/") + "/")
+        for path in paths
+    )
+
+
+def _member_path(name):
+    """Local path of an archive member, which must stay inside MEDIA_ROOT."""
+    parts = name.rstrip("/").split("/")
+    if name.startswith("/") or ".." in parts:
+        raise ValueError(f"Unsafe path {name} in media backup")
+    return os.path.join(settings.MEDIA_ROOT, *parts)
+
+
+def _is_up_to_date(file_path, member):
+    """Whether a local file has the size and CRC of an archive member."""
+    if not os.path.isfile(file_path) or os.path.getsize(file_path) != member.file_size:
+        return False
+    crc = 0
+    with open(file_path, "rb") as fh:
+        for data in iter(lambda: fh.read(MULTIPART_CHUNK_SIZE), b""):
+            crc = zlib.crc32(data, crc)
+    return crc == member.CRC
+
+
+def recover_zip(connexion, remote_key, info, paths=None):
+    """
+    Extract a zipped backup with byte-range GETs, without downloading it.
+
+    Only members matching paths are extracted if given, and files with the
+    size and CRC of the archive are skipped. Members are extracted by
+    DOWNLOAD_N_WORKERS threads, each reading contiguous batches of the
+    archive through its own reader.
+    """
+    archives = []
+    local = threading.local()
+
+    def get_archive():
+        if not hasattr(local, "archive"):
+            local.archive = zipfile.ZipFile(
+                open_range_reader(connexion, BUCKET, remote_key, info)
+            )
+            archives.append(local.archive)
+        return local.archive
+
+    members = [
+        member
+        for member in get_archive().infolist()
+        if not paths or _matches(member.filename, paths)
+    ]
+    if paths and not members:
+        raise ValueError(f"No file matching {', '.join(paths)} in {remote_key}")
+
+    # create folders first so that workers do not race to create them
+    files = []
+    for member in members:
+        file_path = _member_path(member.filename)
+        if member.is_dir():
+            os.makedirs(file_path, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            files.append((member, file_path))
+    files.sort(key=lambda file: file[0].header_offset)
+
+    # batches of neighbour members are read sequentially from the buffer
+    batches = [[]]
+    batch_size = 0
+    for member, file_path in files:
+        if batch_size >= MULTIPART_CHUNK_SIZE:
+            batches.append([])
+            batch_size = 0
+        batches[-1].append((member, file_path))
+        batch_size += member.compress_size
+
+    def extract_batch(batch):
+        n_extracted = 0
+        for member, file_path in batch:
+            if _is_up_to_date(file_path, member):
+                continue
+            with get_archive().open(member) as source, open(file_path, "wb") as fh:
+                shutil.copyfileobj(source, fh, MULTIPART_CHUNK_SIZE)
+            n_extracted += 1
+        return batch, n_extracted
+
+    n_extracted = 0
+    try:
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_N_WORKERS) as executor:
+            with tqdm(total=len(files), desc="Recovering media", unit="file") as pbar:
+                for batch, batch_extracted in executor.map(extract_batch, batches):
+                    n_extracted += batch_extracted
+                    pbar.update(len(batch))
+    finally:
+        for archive in archives:
+            archive.close()
+    print(
+        f"Extracted {n_extracted} files, {len(files) - n_extracted} were already up to date"
+    )
+
+
+def recover_zipped_media(file_name=None, paths=None):
+    """
+    Recover media from a zipped backup.
+
+    paths are glob patterns or folders relative to MEDIA_ROOT restricting
+    the files to recover.
+    """
     connexion = boto_client(BackupType.MAIN)
     if file_name is None or file_name == "latest":
-        backups = get_backups(connexion, ZIPPED_MEDIA_FILE_FORMAT)
+        backups = get_backups(
+            connexion, ZIPPED_MEDIA_FILE_FORMAT, ZIPPED_MEDIA_BACKUP_PREFIX
+        )
         if not len(backups):
             raise ValueError("Could not find any media backup")
         file_name = backups[-1]["key"]["Key"]
 
-    key = connexion.get_object(Bucket=BUCKET, Key=file_name)
-    if not key:
+    info = object_info(connexion, BUCKET, file_name)
+    if not info:
         raise ValueError(f"Wrong input zipped media {file_name}")
 
-    connexion.download_file(Bucket=BUCKET, Key=file_name, Filename=ZIPPED_BACKUP_FILE)
-
-    shutil.unpack_archive(ZIPPED_BACKUP_FILE, settings.MEDIA_ROOT)
-    os.remove(ZIPPED_BACKUP_FILE)
+    if file_name.endswith(MANIFEST_SUFFIX):
+        recover_deduplicated_media(connexion, file_name, paths)
+    else:
+        recover_zip(connexion, file_name, info, paths)
 
 
 def list_saved_zipped_media():
     """List all saved zipped media backups."""
-    backups = get_backups(date_format=ZIPPED_MEDIA_FILE_FORMAT)
+    backups = get_backups(
+        date_format=ZIPPED_MEDIA_FILE_FORMAT, prefix=ZIPPED_MEDIA_BACKUP_PREFIX
+    )
 
     for backup in backups:
         print(backup["key"]["Key"])
@@ -66,10 +420,13 @@ def zipped_media_file_name(date=None) -> str:
     """Generate filename for zipped media backup."""
     if date is None:
         date = datetime.datetime.now()
-    return date.strftime(ZIPPED_MEDIA_FILE_FORMAT)
+    remote_key = backup_key(ZIPPED_MEDIA_FILE_FORMAT, ZIPPED_MEDIA_BACKUP_PREFIX, date)
+    if DEDUPLICATED_MEDIA_BACKUP:
+        return remote_key + MANIFEST_SUFFIX
+    return remote_key
 
 
-def backup_database_and_media(zipped_media=True, overwrite=False):
+def backup_database_and_media(zipped_media=True, overwrite=False, diff=False):
     """Backup database and media files, then create security backup."""
     from .backup import backup_database
     from .security_backup import security_backup
@@ -82,12 +439,12 @@ def backup_database_and_media(zipped_media=True, overwrite=False):
         backup_media()
 
     # Create security backup after regular backup
-    security_backup(overwrite=overwrite)
+    security_backup(overwrite=overwrite, diff=diff)
 
 
-def recover_database_and_media(file_name=None, db_file=None):
+def recover_database_and_media(file_name=None, db_file=None, paths=None):
     """Recover both database and media files."""
     from .backup import recover_database
 
     recover_database(db_file)
-    recover_zipped_media(file_name)
+    recover_zipped_media(file_name, paths)
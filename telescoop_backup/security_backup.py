@@ -1,3 +1,8 @@
+import json
+import os
+import threading
+import time
+
 from django.conf import settings
 from botocore.exceptions import ClientError
 
@@ -5,10 +10,13 @@ from .backup import (
     boto_client,
     BackupType,
     BUCKET,
-    _list_objects_paginated,
+    iter_objects_sharded,
+    iter_prefixes,
     _file_exists_in_bucket,
     _copy_objects_with_progress,
+    _prefetch,
 )
+from .transfer import MAX_CONCURRENCY, TRANSFER_ERRORS, copy_object
 
 
 # Security backup settings
@@ -17,51 +25,250 @@ SECURITY_BACKUP_BUCKET = getattr(settings, "SECURITY_BACKUP_BUCKET", None)
 SECURITY_BACKUP_DESTINATION = (
     getattr(settings, "SECURITY_BACKUP_DESTINATION", None) or "security_backup"
 )
+SECURITY_BACKUP_N_WORKERS = getattr(settings, "SECURITY_BACKUP_N_WORKERS", 10)
+SECURITY_BACKUP_CHECKPOINT_FILE = os.path.join(
+    settings.BASE_DIR, ".telescoop_backup_security_checkpoint.json"
+)
+# seconds between two saves of the checkpoint of a running copy
+CHECKPOINT_INTERVAL = 10
+
+
+class _Checkpoint:
+    """
+    Progress of a security backup or restore, saved to resume it after an interruption.
+
+    Keys are processed in order but copies finish out of order, so the
+    checkpoint records the watermark up to which every key was processed,
+    and the copies pending after it. A resumed run only lists keys after
+    the watermark, which includes the pending copies.
+
+    Only the copies in flight are tracked, each with the key before it:
+    the watermark is the key before the first of them.
+    """
+
+    def __init__(self, operation, options):
+        self.operation = operation
+        self.options = options
+        self.start_after = None
+        self.pending = []
+        checkpoint = self._load().get(operation)
+        if checkpoint and checkpoint["options"] == options:
+            self.start_after = checkpoint["watermark"]
+            self.pending = checkpoint["pending"]
+        # key before each copy in flight, by key in key order
+        self._in_flight = {}
+        self._last_key = self.start_after
+        self._lock = threading.Lock()
+        self._saved_at = time.monotonic()
+        self._closed = False
+
+    def _load(self):
+        if not os.path.isfile(SECURITY_BACKUP_CHECKPOINT_FILE):
+            return {}
+        with open(SECURITY_BACKUP_CHECKPOINT_FILE, "r") as fh:
+            return json.load(fh)
+
+    def _write(self, checkpoints):
+        if not checkpoints:
+            if os.path.isfile(SECURITY_BACKUP_CHECKPOINT_FILE):
+                os.remove(SECURITY_BACKUP_CHECKPOINT_FILE)
+            return
+        tmp_file = f"{SECURITY_BACKUP_CHECKPOINT_FILE}.tmp"
+        with open(tmp_file, "w") as fh:
+            json.dump(checkpoints, fh)
+        os.replace(tmp_file, SECURITY_BACKUP_CHECKPOINT_FILE)
+
+    @property
+    def watermark(self):
+        """Last key up to which every key was processed."""
+        return next(iter(self._in_flight.values()), self._last_key)
+
+    def _advance(self):
+        if time.monotonic() - self._saved_at >= CHECKPOINT_INTERVAL:
+            self._save()
+
+    def skip(self, key):
+        """Record a key that needs no copy."""
+        with self._lock:
+            self._last_key = key
+            self._advance()
+
+    def start(self, key):
+        """Record a key whose copy is about to be scheduled."""
+        with self._lock:
+            self._in_flight[key] = self._last_key
+            self._last_key = key
+
+    def finish(self, key):
+        """Record the end of a copy, successful or not."""
+        with self._lock:
+            del self._in_flight[key]
+            self._advance()
+
+    def _save(self):
+        if self._closed:
+            return
+        checkpoints = self._load()
+        checkpoints[self.operation] = {
+            "options": self.options,
+            "watermark": self.watermark,
+            "pending": list(self._in_flight),
+        }
+        self._write(checkpoints)
+        self._saved_at = time.monotonic()
+
+    def close(self):
+        """Save the checkpoint at the end of the run, unless it completed."""
+        with self._lock:
+            self._save()
+            self._closed = True
+
+    def clear(self):
+        """Forget the checkpoint once the run completed."""
+        with self._lock:
+            self._closed = True
+            checkpoints = self._load()
+            checkpoints.pop(self.operation, None)
+            self._write(checkpoints)
+
+
+def _backup_prefixes():
+    """Prefixes of SECURITY_BACKUP_PATH_LIST in the primary bucket."""
+    # Remove leading slash if present for consistent comparison
+    return [backup_path.lstrip("/") for backup_path in SECURITY_BACKUP_PATH_LIST]
+
+
+def _checkpoint_options(prefixes, **options):
+    """Options of a run, a checkpoint is only resumed by a run with the same ones."""
+    return {
+        "bucket": BUCKET,
+        "security_bucket": SECURITY_BACKUP_BUCKET,
+        "destination": SECURITY_BACKUP_DESTINATION,
+        "prefixes": sorted(prefixes),
+        **options,
+    }
+
+
+def _merge_listings(objects, other_objects, prefix="", other_prefix=""):
+    """
+    Pair each object of a listing with the object of the same key in another one.
+
+    Both listings must be in key order, and keys are compared without
+    prefix and other_prefix. Objects without a match are paired with None.
+    Listings are read once, side by side, so none is held in memory.
+    """
+    other = next(other_objects, None)
+    for obj in objects:
+        key = obj.key[len(prefix) :]
+        while other is not None and other.key[len(other_prefix) :] < key:
+            other = next(other_objects, None)
+        if other is not None and other.key[len(other_prefix) :] == key:
+            yield obj, other
+        else:
+            yield obj, None
+
+
+def _has_changed(source_obj, dest_obj):
+    """Check from their listings if an object differs from its security copy."""
+    if source_obj.size != dest_obj.size:
+        return True
+    if source_obj.etag == dest_obj.etag:
+        return False
+    if "-" in source_obj.etag or "-" in dest_obj.etag:
+        # multipart ETags depend on the part size, rely on dates instead
+        return dest_obj.last_modified < source_obj.last_modified
+    return True
+
+
+def _copy_listing(
+    operation,
+    options,
+    list_objects,
+    list_existing,
+    needs_copy,
+    copy_func,
+    progress_desc,
+    prefix="",
+    other_prefix="",
+):
+    """
+    Copy the objects of a listing that need it, resuming an interrupted run.
+
+    list_objects and list_existing are called with the key to list after,
+    and return listings in key order, of the objects and of the existing
+    copies. list_existing is None to copy every object. needs_copy is
+    called with an object and its existing copy, None if there is none.
+    Keys are compared and checkpointed without prefix and other_prefix.
+
+    Return the number of objects, of copies and of successful copies.
+    """
+    checkpoint = _Checkpoint(operation, options)
+    start_after = checkpoint.start_after
+    if start_after:
+        print(
+            f"Resuming interrupted {operation.replace('_', ' ')} after {start_after} "
+            f"({len(checkpoint.pending)} pending copies are checked again)"
+        )
 
-
-def _get_objects_for_backup_paths(primary_connexion, backup_paths):
-    """Get objects from primary bucket using prefix filtering for each backup path."""
-    matching_objects = []
-
-    for backup_path in backup_paths:
-        # Remove leading slash if present for consistent comparison
-        backup_path = backup_path.lstrip("/")
-        print(f"Fetching objects with prefix: {backup_path}")
-
-        try:
-            path_objects = _list_objects_paginated(
-                primary_connexion, BUCKET, backup_path
+    listings = []
+    try:
+        # both listings are streamed, in key order, and merged on the fly,
+        # each in its own thread so that copies start with the first pages
+        objects = _prefetch(list_objects(start_after and prefix + start_after))
+        listings.append(objects)
+        existing_objects = iter([])
+        if list_existing is not None:
+            existing_objects = _prefetch(
+                list_existing(start_after and other_prefix + start_after)
             )
-            if path_objects:
-                matching_objects.extend(path_objects)
-                print(f"Found {len(path_objects)} objects for prefix '{backup_path}'")
-            else:
-                print(f"No objects found for prefix '{backup_path}'")
-        except ClientError as e:
-            print(f"Error fetching objects for prefix '{backup_path}': {e}")
-            continue
-
-    return matching_objects
+            listings.append(existing_objects)
 
+        n_objects = 0
 
-def _get_existing_security_files(security_connexion):
-    """Get set of existing files in security bucket."""
-    try:
-        all_security_objects = _list_objects_paginated(
-            security_connexion,
-            SECURITY_BACKUP_BUCKET,
-            SECURITY_BACKUP_DESTINATION + "/",
+        def objects_to_copy():
+            nonlocal n_objects
+            for obj, existing_obj in _merge_listings(
+                objects, existing_objects, prefix, other_prefix
+            ):
+                n_objects += 1
+                if not needs_copy(obj, existing_obj):
+                    checkpoint.skip(obj.key[len(prefix) :])
+                    continue
+                checkpoint.start(obj.key[len(prefix) :])
+                yield obj
+
+        def copy(obj, pbar):
+            copied = copy_func(obj, pbar)
+            # interrupted copies are not finished, and are resumed
+            checkpoint.finish(obj.key[len(prefix) :])
+            return copied
+
+        n_copies, n_copied = _copy_objects_with_progress(
+            # filtered in this thread, so that keys are only started when
+            # submitted and the checkpoint holds the copies in flight
+            objects_to_copy(),
+            copy,
+            progress_desc,
+            n_workers=SECURITY_BACKUP_N_WORKERS,
         )
-        existing_files = {obj["Key"] for obj in all_security_objects}
-        print(f"Found {len(existing_files)} existing files in security bucket")
-        return existing_files
-    except ClientError as e:
-        print(f"Warning: Could not list existing security bucket files: {e}")
-        return set()
-
-
-def security_backup(overwrite=False):
-    """Copy files from first bucket to second bucket for security backup, filtering by SECURITY_BACKUP_PATH_LIST."""
+        checkpoint.clear()
+        return n_objects, n_copies, n_copied
+    finally:
+        # listings are not read to the end when a copy fails or nothing is
+        # left to copy, their threads are stopped here
+        for listing in listings:
+            listing.close()
+        checkpoint.close()
+
+
+def security_backup(overwrite=False, diff=False):
+    """
+    Copy files from first bucket to second bucket for security backup, filtering by SECURITY_BACKUP_PATH_LIST.
+
+    By default only files missing from the security bucket are copied. With
+    diff, files whose size or ETag changed are copied again too, and with
+    overwrite every file is copied.
+    """
     if not SECURITY_BACKUP_PATH_LIST:
         print("No paths defined in SECURITY_BACKUP_PATH_LIST, skipping security backup")
         return
@@ -71,71 +278,75 @@ def security_backup(overwrite=False):
         return
 
     # Create connections to both buckets
-    primary_connexion = boto_client(BackupType.MAIN)
-    security_connexion = boto_client(BackupType.SECURITY)
+    max_pool_connections = SECURITY_BACKUP_N_WORKERS * MAX_CONCURRENCY
+    primary_connexion = boto_client(BackupType.MAIN, max_pool_connections)
+    security_connexion = boto_client(BackupType.SECURITY, max_pool_connections)
 
-    try:
-        # Get objects from primary bucket using prefix filtering for each backup path
-        matching_objects = _get_objects_for_backup_paths(
-            primary_connexion, SECURITY_BACKUP_PATH_LIST
-        )
-
-        if not matching_objects:
-            print(f"No objects found matching any paths: {SECURITY_BACKUP_PATH_LIST}")
-            return
-
-        print(f"Total: found {len(matching_objects)} objects matching specified paths")
+    destination_prefix = f"{SECURITY_BACKUP_DESTINATION}/"
+    prefixes = _backup_prefixes()
+    print(f"Listing objects with prefixes: {', '.join(prefixes)}")
 
-        # If not overwriting, get existing files in security bucket to avoid unnecessary checks
-        existing_files = set()
-        if not overwrite:
-            existing_files = _get_existing_security_files(security_connexion)
+    def list_objects(start_after):
+        return iter_prefixes(primary_connexion, BUCKET, prefixes, start_after)
 
-        # Filter objects that actually need to be copied
-        files_to_copy = []
-        for obj in matching_objects:
-            source_key = obj["Key"]
-            dest_key = f"{SECURITY_BACKUP_DESTINATION}/{source_key}"
+    def list_existing(start_after):
+        return iter_prefixes(
+            security_connexion,
+            SECURITY_BACKUP_BUCKET,
+            [destination_prefix + prefix for prefix in prefixes],
+            start_after,
+        )
 
-            if not overwrite and dest_key in existing_files:
-                continue
+    def needs_copy(obj, dest_obj):
+        return dest_obj is None or (diff and _has_changed(obj, dest_obj))
 
-            files_to_copy.append(obj)
+    def copy_object_to_security_bucket(obj, pbar):
+        source_key = obj.key
+        dest_key = f"{SECURITY_BACKUP_DESTINATION}/{source_key}"
+        pbar.set_postfix_str(f"Processing {source_key}")
 
-        if not files_to_copy:
-            print(
-                "No files need to be copied (all files already exist in security bucket)"
+        try:
+            pbar.write(f"Copying {source_key} to security bucket as {dest_key}")
+            copy_object(
+                primary_connexion,
+                BUCKET,
+                source_key,
+                security_connexion,
+                SECURITY_BACKUP_BUCKET,
+                dest_key,
+                obj.size,
             )
-            return
+            return True
+        except TRANSFER_ERRORS as e:
+            pbar.write(f"Error copying {source_key}: {e}")
+            return False
 
-        print(f"Need to copy {len(files_to_copy)} files to security bucket")
-
-        def copy_to_security_bucket(obj, pbar):
-            source_key = obj["Key"]
-            dest_key = f"{SECURITY_BACKUP_DESTINATION}/{source_key}"
-            pbar.set_postfix_str(f"Processing {source_key}")
-
-            try:
-                copy_source = {"Bucket": BUCKET, "Key": source_key}
-                pbar.write(f"Copying {source_key} to security bucket as {dest_key}")
-                security_connexion.copy_object(
-                    CopySource=copy_source,
-                    Bucket=SECURITY_BACKUP_BUCKET,
-                    Key=dest_key,
-                )
-                return True
-            except ClientError as e:
-                pbar.write(f"Error copying {source_key}: {e}")
-                return False
-
-        _copy_objects_with_progress(
-            files_to_copy, copy_to_security_bucket, "Copying files to security bucket"
+    try:
+        n_objects, n_copies, n_copied = _copy_listing(
+            "security_backup",
+            _checkpoint_options(prefixes, overwrite=overwrite, diff=diff),
+            list_objects,
+            None if overwrite else list_existing,
+            needs_copy,
+            copy_object_to_security_bucket,
+            "Copying files to security bucket",
+            other_prefix=destination_prefix,
         )
-
     except ClientError as e:
         print(f"Error listing objects from primary bucket: {e}")
         return
 
+    if not n_objects:
+        print(f"No objects found matching any paths: {SECURITY_BACKUP_PATH_LIST}")
+    elif not n_copies:
+        print(
+            "No files need to be copied (all files are up to date in security bucket)"
+        )
+    else:
+        print(
+            f"Copied {n_copied} of {n_copies} files to copy out of {n_objects} matching objects"
+        )
+
 
 def restore_security_backup(overwrite=False):
     """Copy files from security bucket back to first bucket."""
@@ -144,65 +355,79 @@ def restore_security_backup(overwrite=False):
         return
 
     # Create connections to both buckets
-    primary_connexion = boto_client(BackupType.MAIN)
-    security_connexion = boto_client(BackupType.SECURITY)
+    max_pool_connections = SECURITY_BACKUP_N_WORKERS * MAX_CONCURRENCY
+    primary_connexion = boto_client(BackupType.MAIN, max_pool_connections)
+    security_connexion = boto_client(BackupType.SECURITY, max_pool_connections)
 
-    try:
-        # Get all objects from the security bucket with the security backup prefix using pagination
-        all_objects = _list_objects_paginated(
+    destination_prefix = f"{SECURITY_BACKUP_DESTINATION}/"
+    indexed_prefixes = tuple(_backup_prefixes())
+
+    def list_objects(start_after):
+        return iter_objects_sharded(
             security_connexion,
             SECURITY_BACKUP_BUCKET,
-            SECURITY_BACKUP_DESTINATION + "/",
+            destination_prefix,
+            start_after=start_after,
         )
 
-        if not all_objects:
-            print("No objects found in security backup bucket")
-            return
-
-        print(f"Found {len(all_objects)} objects in security backup bucket")
-
-        def restore_from_security_bucket(obj, pbar):
-            security_key = obj["Key"]
-
-            # Remove the security backup prefix to get the original key
-            if not security_key.startswith(SECURITY_BACKUP_DESTINATION + "/"):
-                pbar.write(f"Skipping {security_key} - not in security backup prefix")
-                return False
+    def list_existing(start_after):
+        return iter_prefixes(primary_connexion, BUCKET, indexed_prefixes, start_after)
+
+    def needs_copy(obj, primary_obj):
+        return primary_obj is None
+
+    def restore_object(obj, pbar):
+        security_key = obj.key
+        original_key = security_key[len(destination_prefix) :]
+        pbar.set_postfix_str(f"Processing {original_key}")
+
+        # keys outside the listed prefixes are checked one by one
+        if (
+            not overwrite
+            and not original_key.startswith(indexed_prefixes)
+            and _file_exists_in_bucket(primary_connexion, BUCKET, original_key)
+        ):
+            pbar.write(
+                f"File {original_key} already exists in primary bucket, skipping (overwrite=False)"
+            )
+            return False
 
-            original_key = security_key[len(SECURITY_BACKUP_DESTINATION) + 1 :]
-            pbar.set_postfix_str(f"Processing {original_key}")
+        try:
+            # Copy object from security bucket to primary bucket
+            pbar.write(f"Restoring {security_key} to primary bucket as {original_key}")
+            copy_object(
+                security_connexion,
+                SECURITY_BACKUP_BUCKET,
+                security_key,
+                primary_connexion,
+                BUCKET,
+                original_key,
+                obj.size,
+            )
+            return True
+        except TRANSFER_ERRORS as e:
+            pbar.write(f"Error restoring {security_key}: {e}")
+            return False
 
-            # Check if file already exists in primary bucket
-            if not overwrite and _file_exists_in_bucket(
-                primary_connexion, BUCKET, original_key
-            ):
-                pbar.write(
-                    f"File {original_key} already exists in primary bucket, skipping (overwrite=False)"
-                )
-                return False
-
-            try:
-                # Copy object from security bucket to primary bucket
-                copy_source = {"Bucket": SECURITY_BACKUP_BUCKET, "Key": security_key}
-                pbar.write(
-                    f"Restoring {security_key} to primary bucket as {original_key}"
-                )
-                primary_connexion.copy_object(
-                    CopySource=copy_source,
-                    Bucket=BUCKET,
-                    Key=original_key,
-                )
-                return True
-            except ClientError as e:
-                pbar.write(f"Error restoring {security_key}: {e}")
-                return False
-
-        _copy_objects_with_progress(
-            all_objects,
-            restore_from_security_bucket,
+    try:
+        n_objects, n_copies, n_restored = _copy_listing(
+            "restore_security_backup",
+            _checkpoint_options(indexed_prefixes, overwrite=overwrite),
+            list_objects,
+            None if overwrite else list_existing,
+            needs_copy,
+            restore_object,
             "Restoring files from security bucket",
+            prefix=destination_prefix,
         )
-
     except ClientError as e:
         print(f"Error listing objects from security backup bucket: {e}")
         return
+
+    if not n_objects:
+        print("No objects found in security backup bucket")
+    else:
+        print(
+            f"Restored {n_restored} of {n_objects} objects in security backup bucket, "
+            f"{n_objects - n_copies} already existed in primary bucket"
+        )
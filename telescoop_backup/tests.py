@@ -1,9 +1,26 @@
+import datetime
+import io
 import json
+import os
+import random
+import tempfile
+from unittest import mock
 
 from django.contrib.auth import get_user_model
-from django.test import TestCase, Client
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, TestCase, Client
 from django.urls import reverse
 
+from . import chunks, security_backup
+from .backup import (
+    ListedObject,
+    _shard_entries,
+    iter_objects_sharded,
+    rewrite_sql_owner,
+)
+from .compression import compressed_reader, decompressed_reader
+from .security_backup import _Checkpoint, _merge_listings
+
 User = get_user_model()
 
 
@@ -25,3 +42,227 @@ class UserDetailsTestCase(TestCase):
         response_data = json.loads(res.content)
         self.assertEqual(response_data["email"], "user@mail.com")
         self.assertEqual(response_data["first_name"], "first")
+
+
+def listed(key, size=1):
+    return ListedObject(key, size, f'"{key}"', datetime.datetime(2024, 1, 1))
+
+
+class FakeConnexion:
+    """In-memory list_objects_v2 of a bucket, with pages of page_size entries."""
+
+    def __init__(self, keys, page_size=1000):
+        self.keys = sorted(keys)
+        self.page_size = page_size
+
+    def list_objects_v2(
+        self, Bucket, Prefix="", Delimiter=None, StartAfter=None, ContinuationToken=None
+    ):
+        entries = []
+        for key in self.keys:
+            if not key.startswith(Prefix) or (StartAfter and key <= StartAfter):
+                continue
+            rest = key[len(Prefix) :]
+            if Delimiter and Delimiter in rest:
+                common_prefix = Prefix + rest[: rest.index(Delimiter) + 1]
+                if not entries or entries[-1] != ("prefix", common_prefix):
+                    entries.append(("prefix", common_prefix))
+            else:
+                entries.append(("key", key))
+        start = int(ContinuationToken or 0)
+        page = entries[start : start + self.page_size]
+        response = {
+            "Contents": [
+                {
+                    "Key": key,
+                    "Size": 1,
+                    "ETag": f'"{key}"',
+                    "LastModified": datetime.datetime(2024, 1, 1),
+                }
+                for kind, key in page
+                if kind == "key"
+            ],
+            "CommonPrefixes": [
+                {"Prefix": prefix} for kind, prefix in page if kind == "prefix"
+            ],
+            "IsTruncated": start + self.page_size < len(entries),
+        }
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = str(start + self.page_size)
+        return response
+
+
+class MergeListingsTestCase(SimpleTestCase):
+    def test_pairs_objects_with_same_key(self):
+        objects = [listed("a/1"), listed("a/2"), listed("a/4")]
+        others = [listed("dest/a/0"), listed("dest/a/2"), listed("dest/a/3")]
+        pairs = list(_merge_listings(iter(objects), iter(others), other_prefix="dest/"))
+        self.assertEqual(
+            [(obj.key, other and other.key) for obj, other in pairs],
+            [("a/1", None), ("a/2", "dest/a/2"), ("a/4", None)],
+        )
+
+    def test_prefix_of_objects(self):
+        objects = [listed("dest/a"), listed("dest/b")]
+        others = [listed("b"), listed("c")]
+        pairs = list(_merge_listings(iter(objects), iter(others), prefix="dest/"))
+        self.assertEqual(
+            [(obj.key, other and other.key) for obj, other in pairs],
+            [("dest/a", None), ("dest/b", "b")],
+        )
+
+    def test_empty_other_listing(self):
+        pairs = list(_merge_listings(iter([listed("a"), listed("b")]), iter([])))
+        self.assertEqual([other for obj, other in pairs], [None, None])
+
+
+class ShardEntriesTestCase(SimpleTestCase):
+    def setUp(self):
+        self.connexion = FakeConnexion(
+            ["a/1/x", "a/1/y", "a/2/z", "a/b", "a/c/d", "a/c/e/f", "b/g"]
+        )
+
+    def test_entries_in_key_order(self):
+        entries = _shard_entries(self.connexion, "bucket", "a/", 3)
+        self.assertEqual(
+            [(key, obj and obj.key) for key, obj in entries],
+            [("a/1/", None), ("a/2/", None), ("a/b", "a/b"), ("a/c/", None)],
+        )
+
+    def test_start_after_keeps_shard_containing_it(self):
+        entries = _shard_entries(self.connexion, "bucket", "a/", 3, "a/1/x")
+        self.assertEqual([key for key, obj in entries], ["a/1/", "a/2/", "a/b", "a/c/"])
+        entries = _shard_entries(self.connexion, "bucket", "a/", 3, "a/b")
+        self.assertEqual([key for key, obj in entries], ["a/c/"])
+
+    def test_truncated_prefix_is_one_shard(self):
+        connexion = FakeConnexion([f"a/{i}" for i in range(10)], page_size=3)
+        entries = _shard_entries(connexion, "bucket", "a/", 4)
+        self.assertEqual(entries, [("a/", None)])
+
+    def test_sharded_listing_is_sorted(self):
+        keys = [f"p/{i % 7}/{i}" for i in range(200)] + [f"p/{i}" for i in range(5)]
+        connexion = FakeConnexion(keys, page_size=10)
+        listed_keys = [
+            obj.key for obj in iter_objects_sharded(connexion, "bucket", "p/", 4)
+        ]
+        self.assertEqual(listed_keys, sorted(keys))
+        listed_keys = [
+            obj.key
+            for obj in iter_objects_sharded(
+                connexion, "bucket", "p/", 4, start_after="p/3/150"
+            )
+        ]
+        self.assertEqual(listed_keys, [key for key in sorted(keys) if key > "p/3/150"])
+
+
+class CheckpointTestCase(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(
+            security_backup,
+            "SECURITY_BACKUP_CHECKPOINT_FILE",
+            os.path.join(directory.name, "checkpoint.json"),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_watermark_waits_for_copies_in_flight(self):
+        checkpoint = _Checkpoint("backup", {})
+        checkpoint.skip("a")
+        checkpoint.start("b")
+        checkpoint.skip("c")
+        checkpoint.start("d")
+        self.assertEqual(checkpoint.watermark, "a")
+        checkpoint.finish("d")
+        self.assertEqual(checkpoint.watermark, "a")
+        checkpoint.finish("b")
+        self.assertEqual(checkpoint.watermark, "d")
+
+    def test_resume_with_same_options(self):
+        checkpoint = _Checkpoint("backup", {"option": 1})
+        checkpoint.skip("a")
+        checkpoint.start("b")
+        checkpoint.start("c")
+        checkpoint.finish("c")
+        checkpoint.close()
+
+        resumed = _Checkpoint("backup", {"option": 1})
+        self.assertEqual(resumed.start_after, "a")
+        self.assertEqual(resumed.pending, ["b"])
+        self.assertIsNone(_Checkpoint("backup", {"option": 2}).start_after)
+        self.assertIsNone(_Checkpoint("restore", {"option": 1}).start_after)
+
+    def test_clear_forgets_checkpoint(self):
+        checkpoint = _Checkpoint("backup", {})
+        checkpoint.skip("a")
+        checkpoint.clear()
+        checkpoint.close()
+        self.assertIsNone(_Checkpoint("backup", {}).start_after)
+        self.assertFalse(
+            os.path.exists(security_backup.SECURITY_BACKUP_CHECKPOINT_FILE)
+        )
+
+
+class RewriteSqlOwnerTestCase(SimpleTestCase):
+    def test_copy_rows_are_not_rewritten(self):
+        lines = [
+            "ALTER TABLE public.a OWNER TO old;\n",
+            "COPY public.a (x) FROM stdin;\n",
+            "ALTER TABLE b OWNER TO old;\t\n",
+            "\\.\n",
+            "ALTER TABLE public.c OWNER TO old;\n",
+        ]
+        self.assertEqual(
+            list(rewrite_sql_owner(lines, "new")),
+            [
+                "ALTER TABLE public.a OWNER TO new;\n",
+                "COPY public.a (x) FROM stdin;\n",
+                "ALTER TABLE b OWNER TO old;\t\n",
+                "\\.\n",
+                "ALTER TABLE public.c OWNER TO new;\n",
+            ],
+        )
+
+
+class CompressionTestCase(SimpleTestCase):
+    def test_readers_round_trip(self):
+        data = b"".join(f"row {i}\n".encode() for i in range(300000))
+        for algorithm in ("gzip", "zstd", "lz4"):
+            with self.subTest(algorithm=algorithm):
+                try:
+                    compressed = compressed_reader(io.BytesIO(data), algorithm).read()
+                except ImproperlyConfigured:
+                    self.skipTest(f"{algorithm} is not installed")
+                self.assertLess(len(compressed), len(data))
+                reader = decompressed_reader(io.BytesIO(compressed), algorithm)
+                self.assertEqual(b"".join(iter(lambda: reader.read(1000), b"")), data)
+
+    def test_no_compression(self):
+        reader = decompressed_reader(io.BytesIO(b"data"), None)
+        self.assertEqual(reader.read(), b"data")
+
+
+@mock.patch.multiple(chunks, CDC_MIN_SIZE=256, CDC_AVERAGE_SIZE=1024, CDC_MAX_SIZE=4096)
+class ContentDefinedChunksTestCase(SimpleTestCase):
+    def setUp(self):
+        self.data = random.Random(0).randbytes(200000)
+
+    def test_chunks_cover_data(self):
+        data_chunks = list(chunks.content_defined_chunks(io.BytesIO(self.data)))
+        self.assertEqual(b"".join(data_chunks), self.data)
+        self.assertTrue(all(len(chunk) <= 4096 for chunk in data_chunks))
+        self.assertTrue(all(len(chunk) >= 256 for chunk in data_chunks[:-1]))
+        self.assertEqual(list(chunks.content_defined_chunks(io.BytesIO(b""))), [])
+
+    def test_insertion_changes_few_chunks(self):
+        edited = self.data[:100000] + b"inserted" + self.data[100000:]
+        before = list(chunks.content_defined_chunks(io.BytesIO(self.data)))
+        after = list(chunks.content_defined_chunks(io.BytesIO(edited)))
+        self.assertLessEqual(len(set(after) - set(before)), 2)
+
+    def test_fixed_size_chunks(self):
+        data_chunks = list(chunks.fixed_size_chunks(io.BytesIO(self.data), 65536))
+        self.assertEqual([len(chunk) for chunk in data_chunks], [65536] * 3 + [3392])
+        self.assertEqual(b"".join(data_chunks), self.data)
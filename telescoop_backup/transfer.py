@@ -0,0 +1,309 @@
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import humanize
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError
+from django.conf import settings
+from tqdm import tqdm
+
+
+# Transfer settings
+MULTIPART_CHUNK_SIZE = getattr(settings, "BACKUP_MULTIPART_CHUNK_SIZE", 8 * 1024**2)
+MAX_CONCURRENCY = getattr(settings, "BACKUP_MAX_CONCURRENCY", 10)
+MAX_BANDWIDTH = getattr(settings, "BACKUP_MAX_BANDWIDTH", None)
+DOWNLOAD_N_WORKERS = getattr(settings, "BACKUP_DOWNLOAD_N_WORKERS", 4)
+MULTIPART_COPY_THRESHOLD = getattr(settings, "BACKUP_MULTIPART_COPY_THRESHOLD", 1024**3)
+MULTIPART_COPY_PART_SIZE = getattr(
+    settings, "BACKUP_MULTIPART_COPY_PART_SIZE", 256 * 1024**2
+)
+
+# S3 multipart uploads have at most this many parts
+MAX_PARTS = 10000
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=MULTIPART_CHUNK_SIZE,
+    multipart_chunksize=MULTIPART_CHUNK_SIZE,
+    max_concurrency=MAX_CONCURRENCY,
+    max_bandwidth=MAX_BANDWIDTH,
+)
+
+# errors that a failed transfer can raise
+TRANSFER_ERRORS = (BotoCoreError, ClientError, S3UploadFailedError)
+# headers kept when an object is copied in parts or across endpoints
+COPIED_HEADERS = (
+    "CacheControl",
+    "ContentDisposition",
+    "ContentEncoding",
+    "ContentLanguage",
+    "ContentType",
+    "Expires",
+    "Metadata",
+)
+
+
+class TransferProgress:
+    """Thread-safe transfer callback showing progress and reporting throughput."""
+
+    def __init__(self, description, total=None, disable=False):
+        self.description = description
+        self.transferred = 0
+        self._lock = threading.Lock()
+        self._pbar = tqdm(
+            total=total,
+            desc=description,
+            unit="B",
+            unit_scale=True,
+            unit_divisor=1024,
+            disable=disable,
+        )
+        self._disable = disable
+        self._start = time.monotonic()
+
+    def __call__(self, bytes_amount):
+        with self._lock:
+            self.transferred += bytes_amount
+            self._pbar.update(bytes_amount)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._pbar.close()
+        if not self._disable and exc_info[0] is None:
+            print(self.summary())
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self._start, 1e-6)
+        size = humanize.naturalsize(self.transferred, binary=True)
+        rate = humanize.naturalsize(self.transferred / elapsed, binary=True)
+        return f"{self.description}: {size} in {elapsed:.1f}s ({rate}/s)"
+
+
+def upload_file(connexion, file_path, bucket, key, progress=True):
+    """Upload a local file with the configured multipart settings."""
+    with TransferProgress(
+        f"Uploading {key}", total=os.path.getsize(file_path), disable=not progress
+    ) as callback:
+        connexion.upload_file(
+            file_path, bucket, key, Config=TRANSFER_CONFIG, Callback=callback
+        )
+
+
+def _stream_config(size):
+    """
+    Transfer config for a stream of about size bytes.
+
+    s3transfer cannot raise the part size of a stream of unknown size to
+    stay under MAX_PARTS, so parts are made large enough for twice size.
+    """
+    if size is None:
+        return TRANSFER_CONFIG
+    chunk_size = -(-2 * size // MAX_PARTS)
+    if chunk_size <= MULTIPART_CHUNK_SIZE:
+        return TRANSFER_CONFIG
+    return TransferConfig(
+        multipart_threshold=MULTIPART_CHUNK_SIZE,
+        multipart_chunksize=chunk_size,
+        max_concurrency=MAX_CONCURRENCY,
+        max_bandwidth=MAX_BANDWIDTH,
+    )
+
+
+def upload_fileobj(connexion, fileobj, bucket, key, progress=True, size=None):
+    """
+    Upload a readable stream with the configured multipart settings.
+
+    Without an estimate of its size, a stream is cut in parts of
+    MULTIPART_CHUNK_SIZE, and the upload fails past MAX_PARTS of them.
+    """
+    with TransferProgress(f"Uploading {key}", disable=not progress) as callback:
+        connexion.upload_fileobj(
+            fileobj, bucket, key, Config=_stream_config(size), Callback=callback
+        )
+
+
+def object_info(connexion, bucket, key):
+    """Return the head_object response for key, or None if it does not exist."""
+    try:
+        return connexion.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+
+
+def download_file(connexion, bucket, key, file_path, info=None, progress=True):
+    """
+    Download an object with concurrent byte-range GETs.
+
+    The destination file is preallocated and each range is written at its
+    offset, so large backups are fetched by DOWNLOAD_N_WORKERS connections.
+    """
+    if info is None:
+        info = object_info(connexion, bucket, key)
+        if info is None:
+            raise ValueError(f"Could not find {key} in bucket {bucket}")
+    size = info["ContentLength"]
+    ranges = [
+        (start, min(start + MULTIPART_CHUNK_SIZE, size) - 1)
+        for start in range(0, size, MULTIPART_CHUNK_SIZE)
+    ]
+
+    with open(file_path, "wb") as fh:
+        fh.truncate(size)
+
+    with TransferProgress(
+        f"Downloading {key}", total=size, disable=not progress
+    ) as callback:
+
+        def download_range(byte_range):
+            start, end = byte_range
+            response = connexion.get_object(
+                Bucket=bucket,
+                Key=key,
+                Range=f"bytes={start}-{end}",
+                IfMatch=info["ETag"],
+            )
+            with open(file_path, "r+b") as fh:
+                fh.seek(start)
+                for chunk in response["Body"].iter_chunks():
+                    fh.write(chunk)
+                    callback(len(chunk))
+
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_N_WORKERS) as executor:
+            # consume the results so that errors are raised
+            list(executor.map(download_range, ranges))
+
+
+class RangeReader(io.RawIOBase):
+    """Seekable read-only view of an object, read with byte-range GETs."""
+
+    def __init__(self, connexion, bucket, key, info):
+        self._connexion = connexion
+        self._bucket = bucket
+        self._key = key
+        self._size = info["ContentLength"]
+        self._etag = info["ETag"]
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._position = offset
+        return self._position
+
+    def readinto(self, buffer):
+        if self._position >= self._size or not len(buffer):
+            return 0
+        end = min(self._position + len(buffer), self._size) - 1
+        data = self._connexion.get_object(
+            Bucket=self._bucket,
+            Key=self._key,
+            Range=f"bytes={self._position}-{end}",
+            IfMatch=self._etag,
+        )["Body"].read()
+        buffer[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+def open_range_reader(connexion, bucket, key, info, buffer_size=1024**2):
+    """Open an object as a seekable binary file, for formats such as zip."""
+    return io.BufferedReader(
+        RangeReader(connexion, bucket, key, info), buffer_size=buffer_size
+    )
+
+
+def _object_headers(response):
+    """Headers of a get_object or head_object response to keep on a copy."""
+    return {header: response[header] for header in COPIED_HEADERS if header in response}
+
+
+def _multipart_copy(connexion, copy_source, size, bucket, key):
+    """Server-side copy of a large object in parts of MULTIPART_COPY_PART_SIZE."""
+    info = connexion.head_object(**copy_source)
+    upload_id = connexion.create_multipart_upload(
+        Bucket=bucket, Key=key, **_object_headers(info)
+    )["UploadId"]
+
+    def copy_part(part_number):
+        start = (part_number - 1) * MULTIPART_COPY_PART_SIZE
+        end = min(start + MULTIPART_COPY_PART_SIZE, size) - 1
+        response = connexion.upload_part_copy(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            CopySource=copy_source,
+            CopySourceRange=f"bytes={start}-{end}",
+            CopySourceIfMatch=info["ETag"],
+        )
+        return {"PartNumber": part_number, "ETag": response["CopyPartResult"]["ETag"]}
+
+    n_parts = -(-size // MULTIPART_COPY_PART_SIZE)
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+            parts = list(executor.map(copy_part, range(1, n_parts + 1)))
+        connexion.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except TRANSFER_ERRORS:
+        connexion.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+
+def copy_object(
+    source_connexion,
+    source_bucket,
+    source_key,
+    dest_connexion,
+    dest_bucket,
+    dest_key,
+    size,
+):
+    """
+    Copy an object between buckets.
+
+    On the same endpoint the copy is done server-side, in parts when the
+    object is larger than MULTIPART_COPY_THRESHOLD. Across endpoints the
+    object is streamed from the source and uploaded to the destination.
+    """
+    if source_connexion.meta.endpoint_url != dest_connexion.meta.endpoint_url:
+        response = source_connexion.get_object(Bucket=source_bucket, Key=source_key)
+        dest_connexion.upload_fileobj(
+            response["Body"],
+            dest_bucket,
+            dest_key,
+            ExtraArgs=_object_headers(response),
+            Config=TRANSFER_CONFIG,
+        )
+        return
+
+    copy_source = {"Bucket": source_bucket, "Key": source_key}
+    if size < MULTIPART_COPY_THRESHOLD:
+        dest_connexion.copy_object(
+            CopySource=copy_source, Bucket=dest_bucket, Key=dest_key
+        )
+    else:
+        _multipart_copy(dest_connexion, copy_source, size, dest_bucket, dest_key)